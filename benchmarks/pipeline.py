@@ -0,0 +1,203 @@
+"""
+    Times the image -> G-code pipeline on synthetic inputs: ScanImageWriter._prepare and process,
+    SmartFitImageWriter.process, GCodeWriter emission and save, load_from_inkscape_gcode.
+    Every stage reports throughput and peak traced memory (tracemalloc, numpy buffers included).
+
+    python benchmarks/pipeline.py [--sizes 200 600 1200] [--save-baseline FILE] [--compare FILE]
+    --compare exits with code 1 when throughput of a stage drops or its peak memory grows more than
+    --tolerance relative to the baseline. Short runs are noisy, use --repeat for regression checks.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+import cv2
+from lib import GCodeWriter
+from image_processing.scan import ScanImageWriter
+from image_processing.smart_fitter import SmartFitImageWriter
+
+TONES = ('gradient', 'noise', 'lineart')
+
+
+def make_image(path, size, tone, seed=0):
+    """ Writes synthetic size x size BGR image: smooth gradient, blurred noise or dark shapes on white """
+    rng = np.random.default_rng(seed)
+    if tone == 'gradient':
+        ramp = np.linspace(0, 255, size)
+        img = ((ramp[None, :] + ramp[:, None]) / 2).astype(np.uint8)
+    elif tone == 'noise':
+        img = cv2.GaussianBlur((rng.random((size, size)) * 255).astype(np.uint8), (0, 0), max(1, size / 50))
+        img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX)
+    else:
+        img = np.full((size, size), 255, dtype=np.uint8)
+        for i in range(12):
+            x1, y1, x2, y2 = rng.integers(0, size, 4).tolist()
+            cv2.line(img, (x1, y1), (x2, y2), int(rng.integers(0, 160)), max(1, size // 100))
+        cv2.circle(img, (size // 2, size // 2), size // 5, 90, -1)
+    cv2.imwrite(path, cv2.cvtColor(img, cv2.COLOR_GRAY2BGR))
+
+
+def make_inkscape_gcode(path, paths, moves, seed=0):
+    """ Writes gcodetools-like file with paths of moves G01 segments each """
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        f.write("%\n(Header)\n(Generated by gcodetools from Inkscape.)\nM3\n")
+        for p in range(paths):
+            points = np.cumsum(rng.normal(0, 1, (moves + 1, 2)), axis=0) + rng.random(2) * 200
+            f.write("(Start cutting path id: path{})\n(Change tool to Default tool)\nG00 Z5.000000\n".format(p))
+            f.write("G00 X{:.6f} Y{:.6f}\n\nG01 Z-0.125000 F100.0(Penetrate)\n".format(*points[0]))
+            f.writelines("G01 X{:.6f} Y{:.6f} Z-0.125000 F400.000000\n".format(x, y) for x, y in points[1:])
+            f.write("G00 Z5.000000\n(End cutting path id: path{})\n".format(p))
+        f.write("M5\n%\n")
+
+
+def new_gcode():
+    gcode = GCodeWriter()
+    gcode.init_laser(left_bottom_corner=[10, 10], default_z=60, default_speed=700, default_power=100)
+    return gcode
+
+
+def measure(stage, repeat):
+    """
+        stage() -> (units, unit name). Best wall time of repeat plain runs and peak memory
+        of one more traced run (tracemalloc slows allocations, so it is not timed).
+    """
+    seconds = float('inf')
+    with redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            started = time.perf_counter()
+            units, unit = stage()
+            seconds = min(seconds, time.perf_counter() - started)
+        tracemalloc.start()
+        try:
+            stage()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return dict(seconds=seconds, throughput=units / max(seconds, 1e-9), unit=unit, peak_mb=peak / 2**20)
+
+
+def image_stages(path, size, shape_count):
+    width = size / 10.  # 10 pixels in mm
+
+    def scan_prepare():
+        im = ScanImageWriter(new_gcode())
+        im.set_image(path, 3)
+        im.set_width(width)
+        im._prepare()
+        return im.image.size / 1e6, 'Mpix/s'
+
+    def scan_process():
+        im = ScanImageWriter(new_gcode())
+        im.set_image(path, 3)
+        im.set_width(width)
+        im.process(distance_mm=1, precision_mm=0.2)
+        return len(im.lines), 'lines/s'
+
+    def smart_fit():
+        im = SmartFitImageWriter(new_gcode())
+        im.set_image(path)
+        im.set_width(width)
+        im.process(epoch_size=shape_count, epoch_count=1, seed=0)
+        return shape_count, 'shapes/s'
+
+    return [('scan_prepare', scan_prepare), ('scan_process', scan_process), ('smart_fit', smart_fit)]
+
+
+def gcode_stages(tmp, element_count, ink_paths, ink_moves):
+    rng = np.random.default_rng(0)
+    lines = (rng.random((element_count, 4)) * 200).tolist()
+    circles = (rng.random((element_count // 10, 3)) * [200, 200, 10]).tolist()
+    out_path = os.path.join(tmp, 'bench.gcode')
+    ink_path = os.path.join(tmp, 'ink.gcode')
+    make_inkscape_gcode(ink_path, ink_paths, ink_moves)
+    state = {}
+
+    def emit():
+        gcode = state['gcode'] = new_gcode()
+        for x1, y1, x2, y2 in lines:
+            gcode.draw_line(x1, y1, x2, y2)
+        for x, y, r in circles:
+            gcode.draw_circle(x, y, r)
+        return len(lines) + len(circles), 'elements/s'
+
+    def save():
+        # toolpath is formatted in save, so the stage emits it again and reports output size throughput
+        emit()
+        state['gcode'].save(out_path)
+        return os.path.getsize(out_path) / 2**20, 'MB/s'
+
+    def load_inkscape():
+        new_gcode().load_from_inkscape_gcode(ink_path, 100, 100, 100)
+        return os.path.getsize(ink_path) / 2**20, 'MB/s'
+
+    return [('gcode_emit', emit), ('gcode_emit_save', save), ('inkscape_load', load_inkscape)]
+
+
+def compare(results, baseline, tolerance):
+    """ Prints throughput ratios against baseline, returns names of regressed stages """
+    regressions = []
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        ratio = res['throughput'] / max(baseline[name]['throughput'], 1e-12)
+        flag = ''
+        if ratio < 1 - tolerance or res['peak_mb'] > baseline[name]['peak_mb'] * (1 + tolerance) + 0.1:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("{:<32} {:6.2f}x baseline throughput, peak {:8.1f} MB (was {:.1f}){}".format(
+            name, ratio, res['peak_mb'], baseline[name]['peak_mb'], flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[200, 600, 1200])
+    parser.add_argument('--tones', nargs='+', default=list(TONES), choices=TONES)
+    parser.add_argument('--shapes', type=int, default=200, help='SmartFit shapes per image')
+    parser.add_argument('--elements', type=int, default=20000, help='lines drawn by gcode_emit')
+    parser.add_argument('--ink-paths', type=int, default=200)
+    parser.add_argument('--ink-moves', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per stage, best one is reported')
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed throughput drop for --compare')
+    args = parser.parse_args()
+    config = dict(shapes=args.shapes, elements=args.elements, ink_paths=args.ink_paths, ink_moves=args.ink_moves)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            for tone in args.tones:
+                path = os.path.join(tmp, '{}-{}.png'.format(tone, size))
+                make_image(path, size, tone)
+                for stage, run in image_stages(path, size, args.shapes):
+                    results['{}/{}-{}'.format(stage, tone, size)] = measure(run, args.repeat)
+        for stage, run in gcode_stages(tmp, args.elements, args.ink_paths, args.ink_moves):
+            results[stage] = measure(run, args.repeat)
+
+    for name, res in results.items():
+        print("{:<32} {:8.3f} s {:12.1f} {:<10} peak {:8.1f} MB".format(
+            name, res['seconds'], res['throughput'], res['unit'], res['peak_mb']))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(dict(config=config, results=results), f, indent=1, sort_keys=True)
+        print("Baseline saved to {}".format(args.save_baseline))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            print("Warning: baseline was made with {}".format(baseline['config']))
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print("{} stages regressed more than {:.0%}".format(len(regressions), args.tolerance))
+            sys.exit(1)
@@ -0,0 +1,47 @@
+"""
+    Compares SmartFitImageWriter shapes/sec with 'stamp' and 'pixels' scoring and batched search
+    on a synthetic image.
+    Run from anywhere: python benchmarks/smart_fit_scoring.py [image_size] [shape_count]
+"""
+import os
+import sys
+import time
+import tempfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+import cv2
+from image_processing.smart_fitter import SmartFitImageWriter
+
+
+def make_image(path, size):
+    img = np.full((size, size, 3), 255, dtype=np.uint8)
+    for i in range(0, size, max(1, size // 8)):
+        cv2.line(img, (0, i), (size - 1, size - 1 - i), (0, 0, 0), max(1, size // 64))
+    cv2.circle(img, (size // 2, size // 2), size // 4, (80, 80, 80), -1)
+    cv2.imwrite(path, img)
+
+
+def run(path, scoring, shape_count, batch_size=1):
+    im = SmartFitImageWriter()
+    im.set_image(path, scoring=scoring)
+    im.set_width(100)
+    start = time.time()
+    im.process(epoch_size=shape_count, epoch_count=1, batch_size=batch_size, seed=0)
+    return shape_count / (time.time() - start), np.abs(im.image).mean()
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    shape_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.png')
+        make_image(path, size)
+        results = {
+            'stamp': run(path, 'stamp', shape_count),
+            'pixels': run(path, 'pixels', shape_count),
+            'batched': run(path, 'pixels', shape_count, batch_size=32),
+        }
+    for name, (speed, residual) in results.items():
+        print("{:>7}: {:8.1f} shapes/sec ({:.2f}x), mean residual {:.2f}".format(
+            name, speed, speed / results['stamp'][0], residual))
@@ -0,0 +1,97 @@
+import math
+from gcode_stream import parse
+
+
+def move_time(distance, feed, acceleration):
+    """
+        Trapezoidal profile starting and ending at rest: seconds to move distance (mm)
+        at feed (mm/s) with acceleration (mm/s^2), triangular when the move is too short to reach feed.
+    """
+    if distance <= 0 or feed <= 0:
+        return 0.
+    if acceleration <= 0:
+        return distance / feed
+    if distance >= feed * feed / acceleration:
+        return distance / feed + feed / acceleration
+    return 2 * math.sqrt(distance / acceleration)
+
+
+def arc_length(start, end, params, clockwise):
+    """ Length of G2/G3 arc given by R or by I, J center offsets """
+    chord = math.hypot(end[0] - start[0], end[1] - start[1])
+    if 'R' in params:
+        r = abs(params['R'])
+        if chord == 0 or r == 0:
+            return 0.
+        angle = 2 * math.asin(min(1., chord / (2 * r)))
+        if params['R'] < 0:
+            angle = 2 * math.pi - angle
+        return r * angle
+    cx, cy = start[0] + params.get('I', 0), start[1] + params.get('J', 0)
+    r = math.hypot(start[0] - cx, start[1] - cy)
+    a1 = math.atan2(start[1] - cy, start[0] - cx)
+    a2 = math.atan2(end[1] - cy, end[0] - cx)
+    angle = (a1 - a2) if clockwise else (a2 - a1)
+    angle %= 2 * math.pi
+    if angle == 0:
+        angle = 2 * math.pi
+    return r * angle
+
+
+def estimate(commands, acceleration=1000., rapid_feed=3000., dwell_units=1.):
+    """
+        Walks G-code commands (see gcode_stream.parse) and estimates job time.
+        Feeds are in mm/min, every move accelerates from and decelerates to rest.
+        G4 P value is multiplied by dwell_units to get seconds (this project writes seconds).
+        Returns dict with total, laser-on, travel and dwell seconds, distances and segment count.
+    """
+    res = {'total': 0., 'laser_on': 0., 'travel': 0., 'dwell': 0.,
+           'laser_on_distance': 0., 'travel_distance': 0., 'segments': 0}
+    position = [0., 0., 0.]
+    feed, laser = rapid_feed, False
+    for c in commands:
+        code, params = c.code, c.params
+        if code in ('G0', 'G1', 'G2', 'G3'):
+            if 'F' in params:
+                feed = params['F']
+            target = list(position)
+            for i, axis in enumerate('XYZ'):
+                if axis in params:
+                    target[i] = params[axis] if c.absolute else position[i] + params[axis]
+            if target == position:
+                continue
+            if code in ('G2', 'G3'):
+                distance = arc_length(position, target, params, code == 'G2')
+                distance = math.hypot(distance, target[2] - position[2])
+            else:
+                distance = math.sqrt(sum((a - b)**2 for a, b in zip(target, position)))
+            seconds = move_time(distance, (rapid_feed if code == 'G0' else feed) / 60., acceleration)
+            kind = 'laser_on' if laser and code != 'G0' else 'travel'
+            res[kind] += seconds
+            res[kind + '_distance'] += distance
+            res['segments'] += 1
+            position = target
+        elif code == 'G4':
+            res['dwell'] += params.get('P', 0) * dwell_units + params.get('S', 0)
+        elif code == 'G28':
+            position = [0., 0., 0.]
+        elif code in ('M106', 'M3', 'M4'):
+            laser = params.get('S', 255) > 0
+        elif code in ('M107', 'M5'):
+            laser = False
+    res['total'] = res['laser_on'] + res['travel'] + res['dwell']
+    return res
+
+
+def estimate_file(filename, **kwargs):
+    with open(filename) as f:
+        return estimate(parse(f), **kwargs)
+
+
+def format_estimate(stats):
+    def hms(seconds):
+        return '{:d}:{:02d}:{:02d}'.format(int(seconds // 3600), int(seconds % 3600 // 60), int(seconds % 60))
+    return ("Estimated time {} (laser on {}, travel {}, dwell {}), "
+            "{} segments, {:.0f} mm burnt, {:.0f} mm travel").format(
+        hms(stats['total']), hms(stats['laser_on']), hms(stats['travel']), hms(stats['dwell']),
+        stats['segments'], stats['laser_on_distance'], stats['travel_distance'])
@@ -0,0 +1,316 @@
+import re
+import sys
+import math
+from collections import namedtuple
+
+
+WORD_RE = re.compile(r'([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+COMMENT_RE = re.compile(r'\(.*?\)|;.*$')
+MOTION_CODES = ('G0', 'G1', 'G2', 'G3')
+AXES = 'XYZ'
+POSITION_WORDS = 'XYZIJR'   # rounded to machine precision, other words (F, P, S, ...) keep at least 4 decimals
+
+
+class Command(namedtuple('Command', ['code', 'params', 'comment', 'absolute'])):
+    """
+        One G-code command. code is normalized ('G01' -> 'G1') or None for lines with comment only,
+        params is dict of letter -> float in file order, absolute is the G90/G91 mode it runs in.
+    """
+    __slots__ = ()
+
+    def replace_params(self, **params):
+        new_params = dict(self.params)
+        new_params.update(params)
+        return self._replace(params=new_params)
+
+    @property
+    def is_motion(self):
+        return self.code in MOTION_CODES
+
+
+def format_number(value, precision=4):
+    """ Fixed precision without trailing zeros: 10.5000 -> 10.5, 3.0000 -> 3 """
+    res = '{:.{}f}'.format(value, precision)
+    if '.' in res:
+        res = res.rstrip('0').rstrip('.')
+    return '0' if res in ('-0', '') else res
+
+
+def word_precision(letter, precision=4):
+    return precision if letter in POSITION_WORDS else max(precision, 4)
+
+
+def format_command(command, precision=4):
+    """ precision applies to positions (POSITION_WORDS), feeds, dwells and powers keep at least 4 decimals """
+    parts = [] if command.code is None else [command.code]
+    parts.extend(letter + format_number(value, word_precision(letter, precision))
+                 for letter, value in command.params.items())
+    if command.comment:
+        parts.append('({})'.format(command.comment))
+    return ' '.join(parts)
+
+
+def parse(lines):
+    """
+        Lazily parses iterable of G-code lines (e.g. an open file) into Command records.
+        Motion mode is modal, so lines with axis words only are returned with the last G0-G3 code.
+        Line numbers (N) and checksums are dropped, empty lines are skipped.
+    """
+    motion, absolute = None, True
+    for line in lines:
+        line = line.split('*')[0].strip()
+        comments = [c.strip('(); ') for c in COMMENT_RE.findall(line)]
+        comment = ' '.join(c for c in comments if c) or None
+        words = [(letter.upper(), value) for letter, value in WORD_RE.findall(COMMENT_RE.sub('', line))]
+        words = [w for w in words if w[0] != 'N']
+        if not words:
+            if comment is not None:
+                yield Command(None, {}, comment, absolute)
+            continue
+
+        codes = [i for i, (letter, _) in enumerate(words) if letter in 'GM']
+        # every G/M word but the last one is a separate command without parameters (e.g. "G21 G90")
+        for i in codes[:-1]:
+            code = words[i][0] + str(int(float(words[i][1])))
+            motion, absolute = _update_modes(code, motion, absolute)
+            yield Command(code, {}, None, absolute)
+        if codes:
+            code = words[codes[-1]][0] + str(int(float(words[codes[-1]][1])))
+            words = words[codes[-1] + 1:]
+            motion, absolute = _update_modes(code, motion, absolute)
+        else:
+            code = motion
+        yield Command(code, {letter: float(value) for letter, value in words}, comment, absolute)
+
+
+def _update_modes(code, motion, absolute):
+    if code in MOTION_CODES:
+        motion = code
+    elif code == 'G90':
+        absolute = True
+    elif code == 'G91':
+        absolute = False
+    return motion, absolute
+
+
+def pipeline(commands, *stages):
+    """ Chains stages, every stage is a function taking and returning an iterable of commands """
+    for stage in stages:
+        commands = stage(commands)
+    return commands
+
+
+def translate(dx=0, dy=0):
+    """ Shifts absolute X and Y of motion commands """
+    def stage(commands):
+        for c in commands:
+            if c.is_motion and c.absolute:
+                params = {}
+                if 'X' in c.params:
+                    params['X'] = c.params['X'] + dx
+                if 'Y' in c.params:
+                    params['Y'] = c.params['Y'] + dy
+                c = c.replace_params(**params)
+            yield c
+    return stage
+
+
+def scale(factor, origin=(0, 0)):
+    """ Scales X and Y around origin, arc offsets (I, J) and radius (R) are scaled too """
+    def stage(commands):
+        for c in commands:
+            if c.is_motion:
+                params = {k: v * factor for k, v in c.params.items() if k in 'IJR'}
+                if 'X' in c.params:
+                    params['X'] = (c.params['X'] - origin[0]) * factor + origin[0] if c.absolute \
+                        else c.params['X'] * factor
+                if 'Y' in c.params:
+                    params['Y'] = (c.params['Y'] - origin[1]) * factor + origin[1] if c.absolute \
+                        else c.params['Y'] * factor
+                c = c.replace_params(**params)
+            yield c
+    return stage
+
+
+def to_bed(left_bottom_corner, factor=1, source_corner=(0, 0)):
+    """
+        Moves job drawn with its left-bottom corner at source_corner into left_bottom_corner space
+        of another bed (see GCodeWriter.init_laser), optionally scaling it around that corner.
+    """
+    def stage(commands):
+        return pipeline(commands,
+                        scale(factor, source_corner),
+                        translate(left_bottom_corner[0] - source_corner[0], left_bottom_corner[1] - source_corner[1]))
+    return stage
+
+
+def remap_z(offset=0, factor=1):
+    """ Z -> Z * factor + offset for absolute moves (only factor for relative ones) """
+    def stage(commands):
+        for c in commands:
+            if c.is_motion and 'Z' in c.params:
+                c = c.replace_params(Z=c.params['Z'] * factor + (offset if c.absolute else 0))
+            yield c
+    return stage
+
+
+def rescale_power(factor, max_power=255, codes=('M106', 'M3', 'M4')):
+    """ Multiplies S word of laser power commands, clamped to [0, max_power] """
+    def stage(commands):
+        for c in commands:
+            if c.code in codes and 'S' in c.params:
+                c = c.replace_params(S=min(max(c.params['S'] * factor, 0), max_power))
+            yield c
+    return stage
+
+
+def clamp_feed(min_feed=0, max_feed=float('inf')):
+    """ Limits every F word to [min_feed, max_feed] """
+    def stage(commands):
+        for c in commands:
+            if 'F' in c.params:
+                c = c.replace_params(F=min(max(c.params['F'], min_feed), max_feed))
+            yield c
+    return stage
+
+
+def precision_for(resolution_mm):
+    """ Decimal places needed to address every step of machine with given resolution (0.0125 -> 2) """
+    return max(0, int(math.ceil(-math.log10(resolution_mm) - 1e-9)))
+
+
+class Compactor(object):
+    """
+        Drops words the machine already has: axes equal to the current absolute position, unchanged F,
+        moves left without parameters and (with modal_motion) repeated G0-G3 codes, which needs firmware
+        with modal motion (GRBL, Marlin with GCODE_MOTION_MODES). Values are rounded as format_command
+        does first, so the elided output is equivalent to the full one formatted with the same precision.
+        Arcs keep all their words. Counts bytes of incoming and produced lines.
+    """
+    def __init__(self, precision=4, modal_motion=False):
+        self.precision = precision
+        self.modal_motion = modal_motion
+        self.position = dict()
+        self.feed = None
+        self.motion = None
+        self.absolute = True
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __round(self, letter, value):
+        return float(format_number(value, word_precision(letter, self.precision)))
+
+    def command(self, c):
+        """
+            Returns compacted command or None when nothing is left of it.
+            Modes are tracked here, so commands may come from separate parse() calls.
+        """
+        params = {k: self.__round(k, v) for k, v in c.params.items()}
+        code = self.motion if c.code is None and params else c.code
+        # motion mode changes only when the command is written, see below
+        self.absolute = _update_modes(code, self.motion, self.absolute)[1]
+        if code in ('G28', 'G92'):
+            self.position.clear()
+            self.motion = None
+        elif code in MOTION_CODES:
+            if 'F' in params:
+                if params['F'] == self.feed:
+                    del params['F']
+                else:
+                    self.feed = params['F']
+            for axis in AXES:
+                if axis not in params:
+                    continue
+                if not self.absolute:
+                    self.position.pop(axis, None)
+                elif code in ('G0', 'G1') and params[axis] == self.position.get(axis):
+                    del params[axis]
+                else:
+                    self.position[axis] = params[axis]
+            if not params:
+                return None
+            modal = self.modal_motion and code == self.motion and any(axis in params for axis in AXES)
+            self.motion = code
+            return c._replace(code=None if modal else code, params=params)
+        return c._replace(code=code, params=params)
+
+    def __call__(self, commands):
+        """ Stage of pipeline (must be the last one, elided codes are None) """
+        for c in commands:
+            c = self.command(c)
+            if c is not None:
+                yield c
+
+    def compact_lines(self, lines):
+        """ Returns compacted text lines for iterable of G-code lines, which may contain newlines """
+        lines = [l for line in lines for l in line.split('\n')]
+        self.bytes_in += sum(len(l) + 1 for l in lines)
+        res = [format_command(c, self.precision) for c in self(parse(lines))]
+        self.bytes_out += sum(len(l) + 1 for l in res)
+        return res
+
+    def report(self):
+        return "Compact output: {} -> {} bytes ({:.0%} saved)".format(
+            self.bytes_in, self.bytes_out, 1 - self.bytes_out / max(self.bytes_in, 1))
+
+
+def motion_sequence(commands, precision=4):
+    """
+        Yields (code, X, Y, Z, F, R, I, J) of every move that changes position (and of every arc),
+        with absolute coordinates rounded to precision. Two programs with equal sequences move the same.
+    """
+    position, feed, absolute = {}, None, True
+    for c in commands:
+        absolute = _update_modes(c.code, None, absolute)[1]
+        if c.code in ('G28', 'G92'):
+            position = {}
+        if not c.is_motion:
+            continue
+        params = {k: float(format_number(v, word_precision(k, precision))) for k, v in c.params.items()}
+        feed = params.get('F', feed)
+        target = dict(position)
+        for axis in AXES:
+            if axis in params:
+                target[axis] = params[axis] if absolute else \
+                    float(format_number(position.get(axis, 0) + params[axis], precision))
+        if target != position or c.code in ('G2', 'G3'):
+            yield (c.code,) + tuple(target.get(axis) for axis in AXES) + (feed,) + \
+                tuple(params.get(k) for k in 'RIJ')
+        position = target
+
+
+def check_compact(lines, precision=4, modal_motion=False):
+    """ Compacts G-code lines and asserts the result makes the same moves, returns compacted lines """
+    lines = [l for line in lines for l in line.split('\n')]
+    compact = Compactor(precision, modal_motion).compact_lines(lines)
+    full_moves = list(motion_sequence(parse(lines), precision))
+    compact_moves = list(motion_sequence(parse(compact), precision))
+    for i, (a, b) in enumerate(zip(full_moves, compact_moves)):
+        assert a == b, "Move {} differs: {} != {}".format(i, a, b)
+    assert len(full_moves) == len(compact_moves), "{} moves instead of {}".format(len(compact_moves), len(full_moves))
+    return compact
+
+
+def rewrite_file(source, destination, *stages, precision=4):
+    """ Streams source through stages into destination in constant memory, returns number of commands """
+    count = 0
+    with open(source) as src, open(destination, 'w') as dst:
+        for command in pipeline(parse(src), *stages):
+            dst.write(format_command(command, precision) + '\n')
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == '--check-compact':
+        # python gcode_stream.py --check-compact input.gcode [precision]
+        with open(sys.argv[2]) as f:
+            lines = f.read().split('\n')
+        for modal_motion in (False, True):
+            compact = check_compact(lines, int(sys.argv[3]) if len(sys.argv) > 3 else 4, modal_motion)
+            print("modal_motion={}: {} -> {} lines, same moves".format(modal_motion, len(lines), len(compact)))
+        sys.exit()
+    # python gcode_stream.py input.gcode output.gcode dx dy
+    source, destination, dx, dy = sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4])
+    count = rewrite_file(source, destination, translate(dx, dy))
+    print("{} commands written to {}".format(count, destination))
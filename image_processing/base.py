@@ -1,10 +1,15 @@
 import numpy as np
 import cv2
 import logging
+import time
+from contextlib import contextmanager
+from preview import render_lines
 
 
 class ImageWriter(object):
     RENDER_PIXELS_IN_MM = 8
+    STRIP_ROWS = 512    # rows converted at once by _single_channel
+    PLACED_KINDS = ('line', 'circle', 'path')
 
     def __init__(self, gcode_writer=None):
         self.gcode = gcode_writer
@@ -13,11 +18,46 @@ class ImageWriter(object):
         self.w = None
         self.h = None
         self.pixel_size = None
+        self.timings = dict()
+        self.cache = None
+        self.lines = []     # placed shapes in pixels: (x1, y1, x2, y2)
+        self.circles = []   # (cx, cy, r)
+        self.paths = []     # open polylines, lists of (x, y)
+        self.placed_order = []  # PLACED_KINDS index of every placed shape
+        self.__cache_start = None
         if self.gcode is None:
             self.logger.warning("All operations with gcode will be ignored. Set it in constructor if you want to fix it.")
 
     def set_image(self, path):
-        self.image = cv2.imread(path)
+        """
+            path - image file or .npy file with (h, w) or (h, w, 3) BGR uint8 array. The .npy file is
+            memory-mapped, so only strips being converted (see _single_channel) are read into memory.
+        """
+        self.image_path = path
+        if path.lower().endswith('.npy'):
+            self.image = np.load(path, mmap_mode='r')
+        else:
+            self.image = cv2.imread(path)
+
+    def _single_channel(self, channel=None):
+        """
+            Returns uint8 (h, w) copy of the image made strip by strip, without 3-channel intermediate:
+            BGR channel with given index or gray (channel None). Single-channel images are copied as is.
+        """
+        res = np.empty(self.image.shape[:2], dtype=np.uint8)
+        for row in range(0, res.shape[0], self.STRIP_ROWS):
+            strip = np.asarray(self.image[row:row + self.STRIP_ROWS])
+            if strip.ndim == 2:
+                res[row:row + len(strip)] = strip
+            elif channel is None:
+                res[row:row + len(strip)] = cv2.cvtColor(strip, cv2.COLOR_BGR2GRAY)
+            else:
+                res[row:row + len(strip)] = strip[:, :, channel]
+        return res
+
+    def set_cache(self, cache):
+        """ cache - image_processing.cache.ResultCache, process() results are reused from it """
+        self.cache = cache
 
     def set_width(self, width_in_mm):
         self.w = width_in_mm
@@ -25,6 +65,41 @@ class ImageWriter(object):
     def __convert_to_mm(self, point):
         return (point[0] * self.pixel_size, point[1] * self.pixel_size)
 
+    @contextmanager
+    def _phase(self, name):
+        """ Adds wall time of the block to self.timings[name] """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.time() - started
+
+    def report_timings(self):
+        for name, seconds in self.timings.items():
+            print("{:>12}: {:.3f} s".format(name, seconds))
+
+    @property
+    def render_image(self):
+        """ Preview of placed lines, RENDER_PIXELS_IN_MM pixels per mm, drawn on request """
+        return self.get_render()
+
+    def get_render(self, pixels_in_mm=None):
+        if pixels_in_mm is None:
+            pixels_in_mm = self.RENDER_PIXELS_IN_MM
+        scale = self.pixel_size * pixels_in_mm
+        lines = np.array(self.lines, dtype=float).reshape(-1, 4) * scale
+        image = render_lines(np.trunc(lines), (self.w * pixels_in_mm, self.h * pixels_in_mm), 1)
+        for cx, cy, r in self.circles:
+            cv2.circle(image, (int(cx * scale), int(cy * scale)), int(round(r * scale)), 0, 1)
+        if self.paths:
+            cv2.polylines(image, [(np.array(p, dtype=float) * scale).astype(np.int32) for p in self.paths],
+                          False, 0, 1)
+        return image
+
+    def save_preview(self, filename, dpi=200):
+        """ Writes preview of placed lines to PNG file, works without GUI """
+        cv2.imwrite(filename, self.get_render(dpi / 25.4))
+
     def render(self):
         cv2.imshow("render", self.render_image)
         cv2.waitKey()
@@ -33,28 +108,103 @@ class ImageWriter(object):
         if self.gcode is None:
             self.logger.warning("Gcode wouldn't be saved. Give it to constructor to solve this issue.")
         else:
-            self.gcode.save(path)
+            with self._phase('save'):
+                self.gcode.save(path)
+
+    def _replay_cached(self, **params):
+        """
+            Looks up results of process() with params in cache. On hit restores them (extra arrays
+            become attributes), places cached lines and returns True. On miss starts recording lines.
+        """
+        if self.cache is None:
+            return False
+        with self._phase('cache'):
+            self.__cache_key = self.cache.key(self.image_path, writer=type(self).__name__, width=self.w, **params)
+            cached = self.cache.get(self.__cache_key)
+        if cached is None:
+            self.__cache_start = self._placed_marks()
+            return False
+        with self._phase('replay'):
+            self.pixel_size, self.h = float(cached.pop('pixel_size')), int(cached.pop('h'))
+            count = self._replay_placed(cached)
+            for name, value in cached.items():
+                setattr(self, name, value)
+        print("Cached result used ({} shapes)".format(count))
+        return True
+
+    def _store_cached(self, **arrays):
+        """ Stores shapes placed since _replay_cached miss together with arrays """
+        if self.cache is None or self.__cache_start is None:
+            return
+        with self._phase('cache'):
+            self.cache.put(self.__cache_key, pixel_size=self.pixel_size, h=self.h,
+                           **self._placed_arrays(self.__cache_start), **arrays)
+        self.__cache_start = None
+
+    def _placed_marks(self):
+        return len(self.lines), len(self.circles), len(self.paths), len(self.placed_order)
+
+    def _placed_arrays(self, marks=(0, 0, 0, 0)):
+        """
+            Shapes placed since marks (see _placed_marks) as arrays: lines (N, 4), circles (N, 3),
+            path_points (M, 2) of all paths, path_sizes with number of points in each path
+            and placed_order with kinds of shapes in placement order
+        """
+        paths = self.paths[marks[2]:]
+        return dict(lines=np.array(self.lines[marks[0]:], dtype=float).reshape(-1, 4),
+                    circles=np.array(self.circles[marks[1]:], dtype=float).reshape(-1, 3),
+                    path_points=np.array([p for path in paths for p in path], dtype=float).reshape(-1, 2),
+                    path_sizes=np.array([len(path) for path in paths], dtype=np.intp),
+                    placed_order=np.array(self.placed_order[marks[3]:], dtype=np.int8))
+
+    def _replay_placed(self, arrays):
+        """ Places shapes from arrays made by _placed_arrays (removing them from dict), returns their count """
+        lines = arrays.pop('lines').tolist()
+        circles = arrays.pop('circles', np.empty((0, 3))).tolist()
+        points, sizes = arrays.pop('path_points', np.empty((0, 2))), arrays.pop('path_sizes', np.empty(0, int))
+        paths = np.split(points, np.cumsum(sizes)[:-1]) if len(sizes) else []
+        order = arrays.pop('placed_order', np.zeros(len(lines), dtype=np.int8))
+        shapes = [iter(lines), iter(circles), iter(paths)]
+        for kind in order.tolist():
+            shape = next(shapes[kind])
+            if kind == 0:
+                self._place_line(shape[:2], shape[2:])
+            elif kind == 1:
+                self._place_circle(shape[:2], shape[2])
+            else:
+                self._place_path(shape.tolist())
+        return len(order)
 
     def _place_line(self, start, end):
+        self.lines.append((start[0], start[1], end[0], end[1]))
+        self.placed_order.append(0)
         start, end = [self.__convert_to_mm(p) for p in [start, end]]
-        cv2.line(
-            self.render_image, 
-            (int(start[0]*self.RENDER_PIXELS_IN_MM), int(start[1]*self.RENDER_PIXELS_IN_MM)),
-            (int(end[0]*self.RENDER_PIXELS_IN_MM), int(end[1]*self.RENDER_PIXELS_IN_MM)),
-            0, 1
-        )
         if self.gcode is not None:
             self.gcode.draw_line(self.w - start[0], start[1], self.w - end[0], end[1])
 
+    def _place_circle(self, center, r):
+        self.circles.append((center[0], center[1], r))
+        self.placed_order.append(1)
+        x, y = self.__convert_to_mm(center)
+        if self.gcode is not None:
+            self.gcode.draw_circle(self.w - x, y, r * self.pixel_size)
+
+    def _place_path(self, points):
+        """ Open polyline through points """
+        self.paths.append([(p[0], p[1]) for p in points])
+        self.placed_order.append(2)
+        points = [self.__convert_to_mm(p) for p in points]
+        if self.gcode is not None:
+            self.gcode.draw_path([(self.w - x, y) for x, y in points], closed=False)
+
     def _image_resized(self, ratio_kept=False):
         if not ratio_kept:
             self.h = int(self.image.shape[0] * self.w / self.image.shape[1])
-            self.render_image = np.zeros((self.h * self.RENDER_PIXELS_IN_MM, self.w * self.RENDER_PIXELS_IN_MM), dtype=np.uint8)
-            self.render_image[:,:] = 255
         self.pixel_size = self.w / (self.image.shape[1] - 1)
 
     def _prepare(self):
         self._image_resized()
 
     def process(self):
-        self._prepare()
+        with self._phase('prepare'):
+            self._prepare()
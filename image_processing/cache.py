@@ -0,0 +1,59 @@
+import os
+import hashlib
+import numpy as np
+
+
+class ResultCache(object):
+    """
+        On-disk cache of image processing results (.npz files) keyed by image content and parameters.
+        Total size is kept under max_bytes by evicting least recently used entries.
+    """
+    def __init__(self, directory=os.path.join('data', 'cache'), max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def file_hash(path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def key(self, path, **params):
+        h = hashlib.sha256(self.file_hash(path).encode())
+        h.update(repr(sorted(params.items())).encode())
+        return h.hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """ Returns dict of arrays or None """
+        path = self.__path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        with np.load(path) as f:
+            return {name: f[name] for name in f.files}
+
+    def put(self, key, **arrays):
+        path = self.__path(key)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
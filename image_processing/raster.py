@@ -0,0 +1,78 @@
+import numpy as np
+import cv2
+from image_processing.base import ImageWriter
+
+
+def scanline_runs(tones, power_lut):
+    """
+        Run-length encodes one scanline of quantized tones. Blank ends are dropped.
+        Returns run edges in dots (len(powers) + 1 values) and power of every run, or None for blank line.
+    """
+    powers = power_lut[tones]
+    burnt = np.flatnonzero(powers)
+    if not len(burnt):
+        return None
+    first, last = burnt[0], burnt[-1] + 1
+    powers = powers[first:last]
+    change = np.flatnonzero(powers[1:] != powers[:-1]) + 1
+    starts = np.append(0, change)
+    return np.append(starts, len(powers)) + first, powers[starts]
+
+
+class RasterImageWriter(ImageWriter):
+    """
+        Grayscale engraving in a single boustrophedon pass. Every scanline is one element burnt
+        with laser power following the image tone (M106 S changes only where quantized power changes).
+    """
+    def set_image(self, path, levels=16):
+        """ levels - number of tones including white (white is not burnt) """
+        super().set_image(path)
+        self.levels = levels
+
+    def _prepare(self):
+        super()._prepare()
+        self.image = self._single_channel()
+
+    def get_render(self, pixels_in_mm=None):
+        """ Burnt tones, darker is more power """
+        if pixels_in_mm is None:
+            pixels_in_mm = self.RENDER_PIXELS_IN_MM
+        gray = (255 - self.tones * 255 // (self.levels - 1)).astype(np.uint8)
+        size = (max(1, int(self.w * pixels_in_mm)), max(1, int(self.h * pixels_in_mm)))
+        return cv2.resize(gray, size, interpolation=cv2.INTER_NEAREST)
+
+    def process(self, line_mm=0.2, dot_mm=None, max_power=None, min_power=0, speed=None):
+        """
+            line_mm - distance between scanlines, dot_mm - tone resolution along scanline (line_mm by default)
+            Darkest tone is burnt with max_power (default power of gcode writer), the lightest burnt one
+            with a step above min_power. speed - feed of burning moves (default speed of gcode writer).
+        """
+        super().process()
+        if dot_mm is None:
+            dot_mm = line_mm
+        if max_power is None:
+            max_power = self.gcode.default_power if self.gcode is not None else 255
+        rows, cols = max(1, int(round(self.h / line_mm))), max(1, int(round(self.w / dot_mm)))
+        step_y, step_x = self.h / rows, self.w / cols
+
+        with self._phase('raster'):
+            gray = cv2.resize(self.image, (cols, rows), interpolation=cv2.INTER_AREA)
+            self.tones = np.rint((255 - gray.astype(np.float32)) * (self.levels - 1) / 255).astype(np.intp)
+            power_lut = np.rint(min_power + (max_power - min_power) * np.arange(self.levels) / (self.levels - 1))
+            power_lut[0] = 0
+
+            scanlines = changes = 0
+            for r in range(rows):
+                runs = scanline_runs(self.tones[r], power_lut)
+                if runs is None:
+                    continue
+                edges, powers = runs
+                xs = self.w - edges * step_x  # mirrored as in _place_line
+                if scanlines % 2:
+                    xs, powers = xs[::-1], powers[::-1]
+                y = (r + 0.5) * step_y
+                if self.gcode is not None:
+                    self.gcode.draw_power_path([(x, y) for x in xs.tolist()], powers, speed=speed)
+                scanlines += 1
+                changes += len(powers) - 1
+        print("Raster: {} scanlines, {} power changes, {} levels".format(scanlines, changes, self.levels))
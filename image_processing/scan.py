@@ -1,7 +1,45 @@
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from image_processing.base import ImageWriter
 
 
+def _samples(start, end, precision_pix):
+    """ Returns x and y pixel coordinates sampled along diagonal from start to end """
+    factor = -1 if (end[0] - start[0]) * (end[1] - start[1]) < 0 else 1
+    if start[0] < end[0]:
+        xs = np.arange(start[0], end[0], precision_pix)
+    else:
+        xs = np.arange(end[0], start[0], precision_pix)[::-1]
+    return xs, start[1] + factor * (xs - start[0])
+
+
+def scan_runs(level_image, lines, min_level, precision_pix):
+    """ Returns (N, 4) array of x1, y1, x2, y2 for all runs of at least two samples with level >= min_level """
+    samples = [_samples(s, e, precision_pix) for s, e in lines]
+    if not samples:
+        return np.zeros((0, 4), dtype=int)
+    xs = np.concatenate([x for x, _ in samples])
+    ys = np.concatenate([y for _, y in samples])
+    line_id = np.repeat(np.arange(len(samples)), [len(x) for x, _ in samples])
+    mask = level_image[ys, xs] >= min_level
+    joined = mask[1:] & mask[:-1] & (line_id[1:] == line_id[:-1])
+    starts = np.flatnonzero(mask & ~np.append(False, joined))
+    ends = np.flatnonzero(mask & ~np.append(joined, False))
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    return np.stack((xs[starts], ys[starts], xs[ends], ys[ends]), axis=1)
+
+
+def _shared_scan_runs(shm_name, shape, lines, min_level, precision_pix):
+    """ scan_runs for worker processes, level image is read from shared memory """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return scan_runs(np.ndarray(shape, dtype=np.uint8, buffer=shm.buf), lines, min_level, precision_pix)
+    finally:
+        shm.close()
+
+
 class ScanImageWriter(ImageWriter):
     def set_image(self, path, levels):
         super().set_image(path)
@@ -10,33 +48,25 @@ class ScanImageWriter(ImageWriter):
 
     def _prepare(self):
         super()._prepare()
-        self.image = self.image[:,:,0]
-        count = []
-        for i in range(256):
-            count.append((i, (self.image == i).sum()))
-        thresholds = []
-        for x in sorted(count, key=lambda x: -x[1]):
-            thresholds.append(x[0])
-            if len(thresholds) == self.levels + 1:
-                break
-        
-        self.level_image = np.zeros(self.image.shape, dtype=np.uint8)
+        self.image = self._single_channel(0)
+        count = np.zeros(256, dtype=np.int64)
+        for row in range(0, len(self.image), self.STRIP_ROWS):  # bincount casts its input to intp
+            count += np.bincount(self.image[row:row + self.STRIP_ROWS].ravel(), minlength=256)
+        thresholds = np.argsort(-count, kind='stable')[:self.levels + 1].tolist()
+
+        # value -> level lookup table, level is the number of threshold midpoints above the value
+        values = np.arange(256)
+        lut = np.zeros(256, dtype=np.uint8)
         last_t = None
         for t in sorted(thresholds, reverse=True):
             if last_t is not None:
-                t_ = (t+last_t)/2
-                self.level_image += (self.image < t_).astype(np.uint8)
+                lut += values < (t+last_t)/2
             last_t = t
-
-    def __values(self, start, end, precision_pix):
-        factor = -1 if (end[0] - start[0]) * (end[1] - start[1]) < 0 else 1
-        if start[0] < end[0]:
-            xs = range(start[0], end[0], precision_pix)
-        if start[0] > end[0]:
-            xs = reversed(list(range(end[0], start[0], precision_pix)))
-        for x in xs:
-            y = int(start[1] + factor * (x - start[0]))
-            yield self.level_image[y, x], (x, y)
+        # levels replace values strip by strip, the channel copy becomes the level image
+        for row in range(0, len(self.image), self.STRIP_ROWS):
+            strip = self.image[row:row + self.STRIP_ROWS]
+            strip[:] = lut[strip]
+        self.level_image = self.image
 
     def __lines(self, distance_pix, shift, crossed=False):
         hp, wp = self.level_image.shape
@@ -58,35 +88,82 @@ class ScanImageWriter(ImageWriter):
                 yield start, end
 
     def __go_pattern(self, distance_pix, shift, min_level, precision_pix, crossed=False):
-        for line_start, line_end in self.__lines(distance_pix, shift, crossed):
-            start_point = None
-            end_point = None
-            for v, p in self.__values(line_start, line_end, precision_pix):
-                if v >= min_level:
-                    if start_point is None:
-                        start_point = p
-                    else:
-                        end_point = p
-                else:
-                    if end_point is not None:
-                        self._place_line(start_point, end_point)
-                    start_point = end_point = None
-            if end_point is not None:
-                self._place_line(start_point, end_point)
-
-    def process(self, distance_mm = 2, precision_mm = 0.2):
+        lines = list(self.__lines(distance_pix, shift, crossed))
+        self.__place_runs(scan_runs(self.level_image, lines, min_level, precision_pix))
+
+    def __place_runs(self, runs):
+        for x1, y1, x2, y2 in runs.tolist():
+            self._place_line((x1, y1), (x2, y2))
+
+    def __go_patterns_parallel(self, distance_pix, patterns, precision_pix, workers, lines_per_task):
+        """
+            Runs patterns in worker processes sharing level_image. Every pattern is split into
+            tasks of lines_per_task diagonals, results are placed in the original order.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(1, self.level_image.nbytes))
+        try:
+            shared = np.ndarray(self.level_image.shape, dtype=np.uint8, buffer=shm.buf)
+            shared[:] = self.level_image
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = []
+                for shift, min_level, crossed in patterns:
+                    lines = list(self.__lines(distance_pix, shift, crossed))
+                    for i in range(0, max(1, len(lines)), lines_per_task):
+                        futures.append(pool.submit(_shared_scan_runs, shm.name, self.level_image.shape,
+                                                   lines[i:i+lines_per_task], min_level, precision_pix))
+                for future in futures:
+                    self.__place_runs(future.result())
+            del shared
+        finally:
+            shm.close()
+            shm.unlink()
+
+    @staticmethod
+    def _hatch_schedule(levels, distance_pix):
+        """
+            Returns distance and list of (shift, min_level, crossed) patterns.
+            First two levels are hatched at shift 0 in both directions, every next level
+            adds both directions at shift subdividing distance (1/2, 1/4, 3/4, 1/8, ...) rounded to pixels.
+            A level whose shift is already hatched gets no patterns (it is burnt as the level below).
+            Only 3 levels round distance up to even, so the half shift is exact.
+        """
+        if levels == 3:
+            distance_pix += distance_pix % 2
+        shifts = {0}
+        patterns = [(0, 1, False)]
+        if levels > 1:
+            patterns.append((0, 2, True))
+        for level in range(3, levels + 1):
+            n, fraction, base = level - 2, 0., 0.5
+            while n:
+                fraction += base * (n & 1)
+                n, base = n >> 1, base / 2
+            shift = int(round(distance_pix * fraction)) % distance_pix
+            if shift in shifts:
+                continue
+            shifts.add(shift)
+            patterns.extend([(shift, level, False), (shift, level, True)])
+        return distance_pix, patterns
+
+    def process(self, distance_mm = 2, precision_mm = 0.2, workers=1, lines_per_task=256):
+        """
+            workers > 1 computes patterns in a process pool, the result is the same as with one worker.
+        """
+        if self._replay_cached(levels=self.levels, distance_mm=distance_mm, precision_mm=precision_mm):
+            return
         super().process()
-        assert self.levels <= 3, "Not implemented for level count > 3"
 
-        distance_pix = int(distance_mm/self.pixel_size)
-        if self.levels > 2:
-            distance_pix = distance_pix + (distance_pix % 2)
+        distance_pix, patterns = self._hatch_schedule(self.levels, int(distance_mm/self.pixel_size))
         precision_pix = max(1, int(precision_mm/self.pixel_size))
+        merged = sorted(set(range(3, self.levels + 1)) - {min_level for _, min_level, _ in patterns})
+        if merged:
+            print("Scan: distance {} px is too small for levels {}, they are burnt as the level below".format(
+                distance_pix, merged))
 
-        self.__go_pattern(distance_pix, 0, 1, precision_pix)
-        if self.levels > 1:
-            self.__go_pattern(distance_pix, 0, 2, precision_pix, crossed=True)
-            if self.levels > 2:
-                self.__go_pattern(distance_pix, distance_pix//2, 3, precision_pix)
-                self.__go_pattern(distance_pix, distance_pix//2, 3, precision_pix, crossed=True)
-
+        with self._phase('hatching'):
+            if workers > 1:
+                self.__go_patterns_parallel(distance_pix, patterns, precision_pix, workers, lines_per_task)
+            else:
+                for shift, min_level, crossed in patterns:
+                    self.__go_pattern(distance_pix, shift, min_level, precision_pix, crossed=crossed)
+        self._store_cached(level_image=self.level_image)
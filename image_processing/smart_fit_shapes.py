@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import numpy as np
 import cv2
 
@@ -8,11 +9,54 @@ def clamp(x, minv, maxv):
         return maxv
     return x
 
+NEIGHBOUR_SHIFTS = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy])
+
+
+class StampCache(object):
+    """
+        LRU of shape pixels (ys, xs, values) keyed by geometry relative to the bounding box corner,
+        so translated copies of a shape share one rasterization. Bounded by bytes of the arrays held.
+    """
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, factory):
+        """ Returns cached entry (tuple of arrays) for key, calls factory() to make it on miss """
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self.__entries[key] = factory()
+            self.bytes += sum(a.nbytes for a in entry)
+            while self.bytes > self.max_bytes and len(self.__entries) > 1:
+                self.bytes -= sum(a.nbytes for a in self.__entries.popitem(last=False)[1])
+        else:
+            self.hits += 1
+            self.__entries.move_to_end(key)
+        return entry
+
+    def clear(self):
+        self.__entries.clear()
+        self.bytes = self.hits = self.misses = 0
+
+
+STAMP_CACHE = StampCache()
+
+
 class Shape(object):
-    def __init__(self, img_w, img_h):
+    def __init__(self, img_w, img_h, rng=None):
+        """ rng - numpy.random.Generator used for creation and morphing (new unseeded one if None) """
         self.img_w = img_w
         self.img_h = img_h
+        self.rng = np.random.default_rng() if rng is None else rng
         self.__stamp = None
+        self.__pixels = None
 
     def _get_bbox(self):
         """ Returns x, y, w, h """
@@ -27,15 +71,66 @@ class Shape(object):
     def _clamp(self, x, y):
         return clamp(x, 0, self.img_w - 1), clamp(y, 0, self.img_h - 1)
 
+    def _stamp_key(self):
+        """
+            Geometry relative to bounding box corner for shapes whose keys repeat (circles by radius),
+            shapes with equal keys share pixels in STAMP_CACHE. None rasterizes without cache.
+        """
+        return None
+
+    def __draw_stamp(self):
+        w, h = self._get_bbox()[2:]
+        img = np.zeros((h, w), dtype=np.int16)
+        self._draw(img)
+        return img
+
+    def __stamp_pixels(self):
+        """ Returns (ys, xs, values) relative to bounding box corner """
+        stamp = self.__draw_stamp()
+        ys, xs = np.nonzero(stamp)
+        return ys, xs, stamp[ys, xs]
+
     def get_stamp(self):
-        """ Returns (x, y, image) """
+        """ Returns (x, y, image), image must not be modified """
         if self.__stamp is None:
             x, y, w, h = self._get_bbox()
-            img = np.zeros((h, w), dtype=np.int16)
-            self._draw(img)
+            key = self._stamp_key()
+            if key is None:
+                img = self.__draw_stamp()
+            else:
+                ys, xs, values = STAMP_CACHE.get(key, self.__stamp_pixels)
+                img = np.zeros((h, w), dtype=np.int16)
+                img[ys, xs] = values
             self.__stamp = x, y, img
         return self.__stamp
 
+    def _get_pixels(self):
+        x, y = self._get_bbox()[:2]
+        key = self._stamp_key()
+        ys, xs, values = self.__stamp_pixels() if key is None else STAMP_CACHE.get(key, self.__stamp_pixels)
+        return ys + y, xs + x, values
+
+    def get_pixels(self):
+        """ Returns (ys, xs, values) - image indices of shape pixels and values subtracted from them """
+        if self.__pixels is None:
+            self.__pixels = self._get_pixels()
+        return self.__pixels
+
+    def _morphing_shift(self, temperature):
+        """ Random point shift scaled by temperature, at least one pixel """
+        if temperature > 0:
+            scale = temperature
+            dx = int(self.img_w * 2 * (self.rng.random() - 0.5) * scale)
+            dy = int(self.img_h * 2 * (self.rng.random() - 0.5) * scale)
+        else:
+            dx, dy = 0, 0
+
+        while dx == 0 and dy == 0:
+            dx = int(self.rng.integers(-1, 2))
+            dy = int(self.rng.integers(-1, 2))
+
+        return dx, dy
+
     def _morph_inplace(self, temperature):
         raise NotImplementedError()
 
@@ -54,11 +149,13 @@ class Shape(object):
 
 
 class LineShape(Shape):
-    def __init__(self, img_w, img_h, copy_from=None):
-        super().__init__(img_w, img_h)
+    VALUE = 85
+
+    def __init__(self, img_w, img_h, copy_from=None, rng=None):
+        super().__init__(img_w, img_h, rng)
         if copy_from is None:
-            self.x1, self.x2 = map(int, (img_w * np.random.random(2)).tolist())
-            self.y1, self.y2 = map(int, (img_h * np.random.random(2)).tolist())
+            self.x1, self.x2 = map(int, (img_w * self.rng.random(2)).tolist())
+            self.y1, self.y2 = map(int, (img_h * self.rng.random(2)).tolist())
         else:
             if isinstance(copy_from, LineShape):
                 self.x1, self.y1, self.x2, self.y2 = copy_from.x1, copy_from.y1, copy_from.x2, copy_from.y2
@@ -72,33 +169,150 @@ class LineShape(Shape):
         return self.bbox
 
     def _draw(self, img):
-        cv2.line(img, (self.x1-self.bbox[0], self.y1-self.bbox[1]), (self.x2-self.bbox[0], self.y2-self.bbox[1]), 85, 1)
+        cv2.line(img, (self.x1-self.bbox[0], self.y1-self.bbox[1]), (self.x2-self.bbox[0], self.y2-self.bbox[1]), self.VALUE, 1)
 
-    def __get_morphing_shift(self, temperature):
-        if temperature > 0:
-            scale = temperature
-            dx = int(self.img_w * 2 * (np.random.random() - 0.5) * scale)
-            dy = int(self.img_h * 2 * (np.random.random() - 0.5) * scale)
-        else:
-            dx, dy = 0, 0
-
-        while dx == 0 and dy == 0:
-            dx = np.random.randint(-1, 2)
-            dy = np.random.randint(-1, 2)
-
-        return dx, dy
+    def _get_pixels(self):
+        """ Pixels of 8-connected line, one per step along the major axis """
+        dx, dy = self.x2 - self.x1, self.y2 - self.y1
+        n = max(abs(dx), abs(dy))
+        t = np.arange(n + 1) / max(n, 1)
+        xs = self.x1 + np.rint(t * dx).astype(np.intp)
+        ys = self.y1 + np.rint(t * dy).astype(np.intp)
+        return ys, xs, np.full(n + 1, self.VALUE, dtype=np.int16)
 
     def _copy(self):
-        return LineShape(self.img_w, self.img_h, copy_from=self)
+        return LineShape(self.img_w, self.img_h, copy_from=self, rng=self.rng)
 
     def _morph_inplace(self, temperature):
-        d1, d2 = [self.__get_morphing_shift(temperature) for i in range(2)]
+        d1, d2 = [self._morphing_shift(temperature) for i in range(2)]
         self.x1, self.y1 = self._clamp(self.x1 + d1[0], self.y1 + d1[1])
         self.x2, self.y2 = self._clamp(self.x2 + d2[0], self.y2 + d2[1])
 
     def to_array(self):
         return np.array([self.x1, self.y1, self.x2, self.y2])
 
+    @staticmethod
+    def random_array(count, img_w, img_h, rng):
+        """ Returns (count, 4) array of random lines x1, y1, x2, y2 """
+        res = np.empty((count, 4), dtype=np.intp)
+        res[:, [0, 2]] = img_w * rng.random((count, 2))
+        res[:, [1, 3]] = img_h * rng.random((count, 2))
+        return res
+
+    @staticmethod
+    def morph_array(arr, count, temperature, img_w, img_h, rng):
+        """ Returns (count, 4) array of lines morphed from line arr the same way morph does it """
+        shifts = np.zeros((count, 2, 2), dtype=np.intp)  # candidate, end point, axis
+        if temperature > 0:
+            scale = 2 * temperature * np.array([img_w, img_h])
+            shifts[:] = scale * (rng.random((count, 2, 2)) - 0.5)
+        zero = (shifts == 0).all(axis=2)
+        shifts[zero] = NEIGHBOUR_SHIFTS[rng.integers(0, len(NEIGHBOUR_SHIFTS), zero.sum())]
+        res = np.asarray(arr).reshape(1, 2, 2) + shifts
+        res[..., 0] = np.clip(res[..., 0], 0, img_w - 1)
+        res[..., 1] = np.clip(res[..., 1], 0, img_h - 1)
+        return res.reshape(count, 4)
+
+    @staticmethod
+    def pixels_array(arr):
+        """ Rasterizes (N, 4) lines at once, returns (line_index, ys, xs) of all their pixels """
+        dx, dy = arr[:, 2] - arr[:, 0], arr[:, 3] - arr[:, 1]
+        n = np.maximum(np.abs(dx), np.abs(dy))
+        idx = np.repeat(np.arange(len(arr)), n + 1)
+        offsets = np.cumsum(n + 1) - (n + 1)
+        t = (np.arange(len(idx)) - offsets[idx]) / np.maximum(n, 1)[idx]
+        xs = arr[idx, 0] + np.rint(t * dx[idx]).astype(np.intp)
+        ys = arr[idx, 1] + np.rint(t * dy[idx]).astype(np.intp)
+        return idx, ys, xs
+
     @staticmethod
     def from_array(self, arr):
-        return LineShape(self.img_w, self.img_h, arr)
\ No newline at end of file
+        return LineShape(self.img_w, self.img_h, arr)
+
+class CircleShape(Shape):
+    """ Circle outline kept inside the image, radius is limited by MAX_RADIUS part of the smaller side """
+    VALUE = LineShape.VALUE
+    MIN_RADIUS = 2
+    MAX_RADIUS = 0.25
+
+    def __init__(self, img_w, img_h, copy_from=None, rng=None):
+        super().__init__(img_w, img_h, rng)
+        if copy_from is None:
+            r = int(self.rng.integers(self.MIN_RADIUS, self.__max_radius() + 1))
+            cx = int(self.rng.integers(r, max(r + 1, img_w - r)))
+            cy = int(self.rng.integers(r, max(r + 1, img_h - r)))
+            self.cx, self.cy, self.r = self.__fit(cx, cy, r)
+        elif isinstance(copy_from, CircleShape):
+            self.cx, self.cy, self.r = copy_from.cx, copy_from.cy, copy_from.r
+        else:
+            self.cx, self.cy, self.r = self.__fit(*map(int, copy_from))
+
+    def __max_radius(self):
+        side = min(self.img_w, self.img_h)
+        return max(self.MIN_RADIUS, min(int(self.MAX_RADIUS * side), (side - 1) // 2))
+
+    def __fit(self, cx, cy, r):
+        """ Clamps radius and center so the circle stays inside the image """
+        r = clamp(r, self.MIN_RADIUS, self.__max_radius())
+        return clamp(cx, r, self.img_w - 1 - r), clamp(cy, r, self.img_h - 1 - r), r
+
+    def _get_bbox(self):
+        return self.cx - self.r, self.cy - self.r, 2 * self.r + 1, 2 * self.r + 1
+
+    def _stamp_key(self):
+        return 'circle', self.r
+
+    def _draw(self, img):
+        cv2.circle(img, (self.r, self.r), self.r, self.VALUE, 1)
+
+    def _copy(self):
+        return CircleShape(self.img_w, self.img_h, copy_from=self, rng=self.rng)
+
+    def _morph_inplace(self, temperature):
+        dx, dy = self._morphing_shift(temperature)
+        dr = int(self.__max_radius() * 2 * (self.rng.random() - 0.5) * temperature) if temperature > 0 else 0
+        self.cx, self.cy, self.r = self.__fit(self.cx + dx, self.cy + dy, self.r + dr)
+
+    def to_array(self):
+        return np.array([self.cx, self.cy, self.r])
+
+
+class PolylineShape(Shape):
+    """ Open polyline of POINTS vertices """
+    VALUE = LineShape.VALUE
+    POINTS = 3
+
+    def __init__(self, img_w, img_h, copy_from=None, rng=None):
+        super().__init__(img_w, img_h, rng)
+        if copy_from is None:
+            self.points = (self.rng.random((self.POINTS, 2)) * [img_w, img_h]).astype(np.intp)
+        elif isinstance(copy_from, PolylineShape):
+            self.points = copy_from.points.copy()
+        else:
+            self.points = np.asarray(copy_from, dtype=np.intp).reshape(-1, 2).copy()
+            self.__clip()
+
+    def __clip(self):
+        np.clip(self.points[:, 0], 0, self.img_w - 1, out=self.points[:, 0])
+        np.clip(self.points[:, 1], 0, self.img_h - 1, out=self.points[:, 1])
+
+    def _get_bbox(self):
+        (x, y), (x2, y2) = self.points.min(axis=0), self.points.max(axis=0)
+        return int(x), int(y), int(x2 - x) + 1, int(y2 - y) + 1
+
+    def _draw(self, img):
+        pts = (self.points - self.points.min(axis=0)).astype(np.int32)
+        cv2.polylines(img, [pts], False, self.VALUE, 1)
+
+    def _copy(self):
+        return PolylineShape(self.img_w, self.img_h, copy_from=self, rng=self.rng)
+
+    def _morph_inplace(self, temperature):
+        self.points += [self._morphing_shift(temperature) for i in range(len(self.points))]
+        self.__clip()
+
+    def to_array(self):
+        return self.points.ravel().copy()
+
+
+SHAPES = {'line': LineShape, 'circle': CircleShape, 'polyline': PolylineShape}
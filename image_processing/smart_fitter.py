@@ -2,53 +2,193 @@ if __name__ == "__main__":
     import sys, os
     sys.path.append(os.path.abspath('..'))
     
+import os
+import json
 import numpy as np
 import cv2
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from image_processing.base import ImageWriter
-from image_processing.smart_fit_shapes import LineShape
+from image_processing.smart_fit_shapes import LineShape, CircleShape, PolylineShape, SHAPES
 
 __all__ = ['SmartFitImageWriter']
 
 
+def _fit_tile(shm_name, image_shape, bounds, shape_count, batch_size, seed, adaptive=False):
+    """
+        Worker of tiled processing: fits shape_count lines into private copy of residual
+        region bounds = (x0, y0, x1, y1). Returns values and accepted lines in image coordinates.
+    """
+    x0, y0, x1, y1 = bounds
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        residual = np.ndarray(image_shape, dtype=np.int16, buffer=shm.buf)[y0:y1, x0:x1].copy()
+    finally:
+        shm.close()
+    fitter = SmartFitImageWriter.for_residual(residual, rng=np.random.default_rng(seed))
+    fitter._set_adaptive(adaptive)
+    values, accepted = fitter._fit_shapes(shape_count, batch_size)
+    lines = np.array([s.to_array() for s in accepted], dtype=np.intp).reshape(-1, 4) + [x0, y0, x0, y0]
+    return values, lines
+
 
 class SmartFitImageWriter(ImageWriter):
-    def set_image(self, path, approx_level=1):
+    ACCEPT_THRESHOLD = 0.8
+    MAX_SEED_TRIES = 1000   # random shapes tried before search gives up (image is nearly exhausted)
+    SEED_RADIUS = 0.2       # adaptive mode: max line extent from seeded end point, part of image size
+    COOLING = 0.985         # adaptive mode: temperature multiplier per candidate
+    PATIENCE = 60           # adaptive mode: candidates without improvement before search stops
+    adaptive = False
+    _seed_cdf = None
+    shape_types = (LineShape,)
+
+    def set_image(self, path, approx_level=1, scoring='pixels'):
         """
             approx_level means how rude can be approximation.
             So, image will be resized with scale_ratio equal to 1/approx_level
+            scoring - 'pixels' compares residual only on shape pixels (cost grows with line length),
+            'stamp' compares the whole bounding box of the shape (previous behaviour)
         """
         self.approx_level = approx_level
+        self.scoring = scoring
         super().set_image(path)
 
     def _prepare(self):
         super()._prepare()
+        self.image = self._single_channel()
         if self.approx_level > 1:
             h_, w_ = self.image.shape[:2]
             self.image = cv2.resize(self.image, (w_//self.approx_level, h_//self.approx_level))
             self._image_resized(ratio_kept=True)
-        self.image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
         maxv, minv = self.image.max(), self.image.min()
         self.image = (255 * ((maxv - self.image) / (maxv - minv))).astype(np.int16)
 
+    def _set_adaptive(self, adaptive):
+        """
+            Adaptive search seeds lines at pixels drawn with probability proportional to positive
+            residual, cools temperature geometrically and stops a search after PATIENCE candidates
+            without improvement.
+        """
+        self.adaptive = adaptive
+        self._seed_cdf = None
+        if adaptive:
+            cdf = np.cumsum(np.maximum(self.image, 0).ravel(), dtype=np.float64)
+            if cdf[-1] > 0:
+                self._seed_cdf = cdf
+
+    def __seeded_array(self, count):
+        """ (count, 4) lines starting at pixels sampled from residual distribution """
+        h, w = self.image.shape
+        idx = np.searchsorted(self._seed_cdf, self.rng.random(count) * self._seed_cdf[-1], side='right')
+        y1, x1 = np.divmod(np.minimum(idx, h * w - 1), w)
+        radius = max(1, int(self.SEED_RADIUS * max(w, h)))
+        x2 = np.clip(x1 + self.rng.integers(-radius, radius + 1, count), 0, w - 1)
+        y2 = np.clip(y1 + self.rng.integers(-radius, radius + 1, count), 0, h - 1)
+        return np.stack((x1, y1, x2, y2), axis=1)
+
     def __get_random_shape(self):
-        return LineShape(self.image.shape[1], self.image.shape[0])
+        h, w = self.image.shape
+        kind = self.shape_types[0]
+        if len(self.shape_types) > 1:
+            kind = self.shape_types[int(self.rng.integers(len(self.shape_types)))]
+        if self._seed_cdf is None:
+            return kind(w, h, rng=self.rng)
+        x1, y1, x2, y2 = self.__seeded_array(1)[0]
+        if kind is CircleShape:
+            return kind(w, h, (x1, y1, max(abs(x2 - x1), abs(y2 - y1))), rng=self.rng)
+        if kind is PolylineShape:
+            seeds = self.__seeded_array(kind.POINTS - 2)
+            tail = [x2, y2] + np.cumsum(seeds[:, 2:] - seeds[:, :2], axis=0)
+            return kind(w, h, np.vstack(([x1, y1], [x2, y2], tail)), rng=self.rng)
+        return kind(w, h, (x1, y1, x2, y2), rng=self.rng)
+
+    def __temperature(self, score, i):
+        if self.adaptive:
+            return (0.9 - score) * self.COOLING ** i
+        return 0.9 - score
 
     def __get_random_best_shape(self, max_iter=300, eps=0.001, min_threshold=0.01):
         best_shape, score = None, -1
-        while score < min_threshold:
+        for attempt in range(self.MAX_SEED_TRIES):
             best_shape = self.__get_random_shape()
             score = self.__value(best_shape)
+            if score >= min_threshold:
+                break
+        else:
+            return None, -1
 
+        since_improvement = 0
         for i in range(max_iter):
-            shape = best_shape.morph(0.9-score)
+            shape = best_shape.morph(self.__temperature(score, i))
             value = self.__value(shape)
             if value > score:
                 best_shape, score = shape, value
+                since_improvement = 0
+            else:
+                since_improvement += 1
             if value > 1 - eps:
                 break
+            if self.adaptive and since_improvement >= self.PATIENCE:
+                break
         return best_shape, score
 
+    def __get_random_best_shape_batched(self, batch_size, max_iter=300, eps=0.001, min_threshold=0.01):
+        """ Same search as __get_random_best_shape, but morphs and scores batch_size lines at once """
+        h, w = self.image.shape
+        best, score = None, -1
+        for attempt in range(0, self.MAX_SEED_TRIES, batch_size):
+            if self._seed_cdf is not None:
+                lines = self.__seeded_array(batch_size)
+            else:
+                lines = LineShape.random_array(batch_size, w, h, self.rng)
+            values = self.__batch_values(lines)
+            good = np.flatnonzero(values >= min_threshold)
+            if len(good):
+                best, score = lines[good[0]], values[good[0]]
+                break
+        if best is None:
+            return None, -1
+
+        since_improvement = 0
+        for i in range(0, max_iter, batch_size):
+            count = min(batch_size, max_iter - i)
+            lines = LineShape.morph_array(best, count, self.__temperature(score, i), w, h, self.rng)
+            values = self.__batch_values(lines)
+            j = values.argmax()
+            if values[j] > score:
+                best, score = lines[j], values[j]
+                since_improvement = 0
+            else:
+                since_improvement += count
+            if values[j] > 1 - eps:
+                break
+            if self.adaptive and since_improvement >= self.PATIENCE:
+                break
+        return LineShape(w, h, best, rng=self.rng), float(score)
+
+    def __batch_values(self, lines):
+        """ Vectorized __pixels_value for (N, 4) array of lines """
+        idx, ys, xs = LineShape.pixels_array(lines)
+        res = self.image[ys, xs] - LineShape.VALUE
+        weight = LineShape.VALUE * np.bincount(idx, minlength=len(lines))
+        bad_weight = -np.bincount(idx, weights=np.minimum(res, 0), minlength=len(lines))
+        return (weight - bad_weight) / weight
+
     def __value(self, shape):
+        if self.scoring == 'pixels':
+            return self.__pixels_value(shape)
+        return self.__stamp_value(shape)
+
+    def __pixels_value(self, shape):
+        ys, xs, values = shape.get_pixels()
+        weight = values.sum()
+        if weight < 1:
+            return -1
+        res = self.image[ys, xs] - values
+        bad_weight = -(res[res<0].sum())
+        return (weight - bad_weight) / weight
+
+    def __stamp_value(self, shape):
         x, y, stamp = shape.get_stamp()
         res = self.image[y:y+stamp.shape[0], x:x+stamp.shape[1]] - stamp
         weight = stamp.sum()
@@ -58,13 +198,97 @@ class SmartFitImageWriter(ImageWriter):
             return -1
         return good_weight / weight
 
-    def __apply(self, shape):
-        x, y, stamp = shape.get_stamp()
-        self.image[y:y+stamp.shape[0], x:x+stamp.shape[1]] -= stamp
-        if stamp.shape[1] < abs(shape.x1 - shape.x2):
-            raise Exception("{}, {}".format(stamp.shape[0], abs(shape.y1 - shape.y2)))
+    @classmethod
+    def for_residual(cls, residual, scoring='pixels', rng=None):
+        """ Fitter working directly on residual image, without G-code output """
+        res = cls.__new__(cls)
+        res.image = residual
+        res.scoring = scoring
+        res.rng = np.random.default_rng() if rng is None else rng
+        return res
+
+    def __subtract(self, shape):
+        if self.scoring == 'pixels':
+            ys, xs, values = shape.get_pixels()
+            self.image[ys, xs] -= values
+        else:
+            x, y, stamp = shape.get_stamp()
+            self.image[y:y+stamp.shape[0], x:x+stamp.shape[1]] -= stamp
+            if isinstance(shape, LineShape) and stamp.shape[1] < abs(shape.x1 - shape.x2):
+                raise Exception("{}, {}".format(stamp.shape[0], abs(shape.y1 - shape.y2)))
+
+    def __place(self, shape):
         if isinstance(shape, LineShape):
             self._place_line([shape.x1, shape.y1], [shape.x2, shape.y2])
+        elif isinstance(shape, CircleShape):
+            self._place_circle([shape.cx, shape.cy], shape.r)
+        elif isinstance(shape, PolylineShape):
+            self._place_path(shape.points.tolist())
+
+    def __apply(self, shape):
+        self.__subtract(shape)
+        self.__place(shape)
+
+    def _fit_shapes(self, count, batch_size=1):
+        """ Searches count shapes, subtracts accepted ones from residual. Returns values and accepted shapes """
+        values, accepted = [], []
+        for i in range(count):
+            if batch_size > 1:
+                shape, value = self.__get_random_best_shape_batched(batch_size)
+            else:
+                shape, value = self.__get_random_best_shape()
+            values.append(value)
+            if value > self.ACCEPT_THRESHOLD:
+                self.__subtract(shape)
+                accepted.append(shape)
+        return values, accepted
+
+    @staticmethod
+    def __tile_bounds(w, h, tiles, margin):
+        """ Returns list of (core, extended) bounds (x0, y0, x1, y1) for rows x cols grid """
+        rows, cols = tiles
+        xs = np.linspace(0, w, cols + 1).astype(int)
+        ys = np.linspace(0, h, rows + 1).astype(int)
+        res = []
+        for r in range(rows):
+            for c in range(cols):
+                core = xs[c], ys[r], xs[c+1], ys[r+1]
+                extended = max(0, core[0] - margin), max(0, core[1] - margin), \
+                    min(w, core[2] + margin), min(h, core[3] + margin)
+                res.append((tuple(map(int, core)), tuple(map(int, extended))))
+        return res
+
+    def __run_tiled_epoch(self, pool, shm, epoch_size, batch_size, tiles, margin):
+        """
+            Fits tiles in parallel against snapshot of residual in shared memory, then merges:
+            lines inside their tile core are applied as is, lines reaching into the overlap margin
+            are scored again against the merged residual and applied only if they still fit.
+        """
+        h, w = self.image.shape
+        np.ndarray(self.image.shape, dtype=np.int16, buffer=shm.buf)[:] = self.image
+        bounds = self.__tile_bounds(w, h, tiles, margin)
+        count = max(1, epoch_size // len(bounds))
+        futures = [pool.submit(_fit_tile, shm.name, self.image.shape, extended, count, batch_size,
+                               int(self.rng.integers(2**31)), self.adaptive)
+                   for core, extended in bounds]
+        values, applied, rejected, border_lines = [], 0, 0, []
+        for (x0, y0, x1, y1), future in zip([core for core, _ in bounds], futures):
+            tile_values, lines = future.result()
+            values.extend(tile_values)
+            inside = (lines[:, [0, 2]] >= x0).all(1) & (lines[:, [0, 2]] < x1).all(1) & \
+                (lines[:, [1, 3]] >= y0).all(1) & (lines[:, [1, 3]] < y1).all(1)
+            for line in lines[inside]:
+                self.__apply(LineShape(w, h, line, rng=self.rng))
+                applied += 1
+            border_lines.extend(lines[~inside])
+        for line in border_lines:
+            shape = LineShape(w, h, line, rng=self.rng)
+            if self.__value(shape) > self.ACCEPT_THRESHOLD:
+                self.__apply(shape)
+                applied += 1
+            else:
+                rejected += 1
+        return values, applied, rejected
 
     def __show_image(self, winname='image', wait=0):
         cv2.imshow(winname, np.dstack((self.image * (self.image >= 0), 
@@ -72,25 +296,110 @@ class SmartFitImageWriter(ImageWriter):
                                        np.abs(self.image))).astype(np.uint8))
         cv2.waitKey(wait)
 
-    def process(self, epoch_size=2000, epoch_count=10, render_epoch=False):
+    def __energy(self):
+        """ Positive residual left to burn """
+        return float(np.maximum(self.image, 0).sum())
+
+    def __save_checkpoint(self, path, epoch_i, marks):
+        """ Residual, shapes accepted since marks and random state after epoch_i, written atomically """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, image=self.image, epoch=epoch_i, rng_state=json.dumps(self.rng.bit_generator.state),
+                     **self._placed_arrays(marks))
+        os.replace(tmp_path, path)
+
+    def __load_checkpoint(self, path):
+        """ Restores state saved by __save_checkpoint, returns the first epoch to run """
+        with np.load(path) as f:
+            self.image = f['image'].copy()
+            self.rng.bit_generator.state = json.loads(str(f['rng_state']))
+            self._replay_placed({name: f[name] for name in f.files
+                                 if name not in ('image', 'epoch', 'rng_state')})
+            epoch = int(f['epoch'])
+        print("Resumed from {} after epoch {}".format(path, epoch + 1))
+        return epoch + 1
+
+    def process(self, epoch_size=2000, epoch_count=10, render_epoch=False, batch_size=1,
+                workers=1, tiles=None, tile_margin=None, seed=None, checkpoint=None,
+                adaptive=False, min_acceptance=0.02, min_energy_drop=0.001, shapes=('line',)):
+        """
+            batch_size > 1 evaluates that many morphed candidates at once (needs 'pixels' scoring)
+            workers > 1 splits every epoch between tiles (rows, cols) fitted in worker processes,
+            tiles overlap by tile_margin pixels (default is a quarter of the smaller tile side)
+            seed makes the run reproducible (all randomness comes from one numpy Generator)
+            checkpoint - path of file updated after every epoch; if it exists the run resumes from it
+            adaptive - residual-biased seeding with cooling search (see _set_adaptive); the run stops
+            early once part of accepted shapes in epoch drops below min_acceptance or an epoch removes
+            less than min_energy_drop of the initial positive residual
+            shapes - names of fitted shape kinds from smart_fit_shapes.SHAPES: 'line', 'circle', 'polyline';
+            circles and polylines are written as G2 circles and open paths (single process, batch_size 1)
+        """
+        if self._replay_cached(approx_level=self.approx_level, scoring=self.scoring, epoch_size=epoch_size,
+                               epoch_count=epoch_count, batch_size=batch_size, workers=workers, tiles=tiles,
+                               tile_margin=tile_margin, seed=seed, adaptive=adaptive,
+                               min_acceptance=min_acceptance, min_energy_drop=min_energy_drop,
+                               shapes=tuple(shapes)):
+            return
+        self.rng = np.random.default_rng(seed)
+        self.shape_types = tuple(SHAPES[name] for name in shapes)
         super().process()
+        marks, first_epoch = self._placed_marks(), 0
+        if checkpoint is not None and os.path.exists(checkpoint):
+            first_epoch = self.__load_checkpoint(checkpoint)
+        assert batch_size == 1 or self.scoring == 'pixels', "Batched search works with 'pixels' scoring only"
+        assert (batch_size == 1 and workers == 1) or self.shape_types == (LineShape,), \
+            "Batched search and tiled processing work with lines only"
+        pool = shm = None
+        if workers > 1:
+            assert self.scoring == 'pixels', "Tiled processing works with 'pixels' scoring only"
+            if tiles is None:
+                cols = int(np.ceil(np.sqrt(workers)))
+                tiles = (int(np.ceil(workers / cols)), cols)
+            if tile_margin is None:
+                tile_margin = min(self.image.shape[0] // tiles[0], self.image.shape[1] // tiles[1]) // 4
+            shm = shared_memory.SharedMemory(create=True, size=self.image.nbytes)
+            pool = ProcessPoolExecutor(max_workers=workers)
         if render_epoch:
             cv2.namedWindow('processing') #, cv2.WINDOW_NORMAL)
-        for epoch_i in range(epoch_count):
-            print("Running epoch {}/{}".format(epoch_i+1, epoch_count))
-            values, applied = [], 0
-            for i in range(epoch_size):
-                shape, value = self.__get_random_best_shape()
-                values.append(value)
-                if value > 0.8:
-                    applied += 1
-                    self.__apply(shape)
-            if render_epoch:
-                self.__show_image("processing", 0 if epoch_i == epoch_count - 1 else 100)
-            print("Values mean: {}, Values max: {}, Applied: {}".format(np.mean(values), np.max(values), applied))
-                
+        start_energy = energy = self.__energy()
+        try:
+            for epoch_i in range(first_epoch, epoch_count):
+                print("Running epoch {}/{}".format(epoch_i+1, epoch_count))
+                with self._phase('fitting'):
+                    self._set_adaptive(adaptive)
+                    if pool is not None:
+                        values, applied, rejected = self.__run_tiled_epoch(pool, shm, epoch_size, batch_size,
+                                                                           tiles, tile_margin)
+                    else:
+                        values, accepted = self._fit_shapes(epoch_size, batch_size)
+                        for shape in accepted:
+                            self.__place(shape)
+                        applied, rejected = len(accepted), 0
+                if render_epoch:
+                    self.__show_image("processing", 0 if epoch_i == epoch_count - 1 else 100)
+                print("Values mean: {}, Values max: {}, Applied: {}{}".format(
+                    np.mean(values), np.max(values), applied,
+                    ", Rejected on merge: {}".format(rejected) if pool is not None else ''))
+                if checkpoint is not None:
+                    self.__save_checkpoint(checkpoint, epoch_i, marks)
+                if adaptive:
+                    new_energy = self.__energy()
+                    acceptance = applied / max(1, len(values))
+                    energy_drop = (energy - new_energy) / max(start_energy, 1)
+                    energy = new_energy
+                    if acceptance < min_acceptance or energy_drop < min_energy_drop:
+                        print("Converged after epoch {}: acceptance {:.3f}, residual drop {:.4f}".format(
+                            epoch_i+1, acceptance, energy_drop))
+                        break
+        finally:
+            if pool is not None:
+                pool.shutdown()
+                shm.close()
+                shm.unlink()
+
         if render_epoch:
             cv2.destroyAllWindows()
+        self._store_cached(image=self.image)
 
 
 
@@ -98,7 +407,10 @@ if __name__ == "__main__":
     import os, sys
     sys.path.append(os.path.abspath('..'))
 
+    from image_processing.cache import ResultCache
+
     im = SmartFitImageWriter()
+    im.set_cache(ResultCache(os.path.join('..', 'data', 'cache')))
     im.set_image(os.path.join('..', 'data', 'img', 'fit-test.png'), 2)
 
     im.set_width(149)
@@ -1,14 +1,140 @@
 import re
 import os
+import time
+from array import array
+import numpy as np
+import cv2
+from toolpath import Toolpath, format_toolpath, CMD_TRAVEL, CMD_Z, CMD_LINE, CMD_ARC, CMD_RAW
+import optimizer
+import estimator
+import preview
+from gcode_stream import parse, Compactor, precision_for
+from sender import SerialSender
+
+
+COMMENT_RE = re.compile(r'\(.*?\)')
+PATH_START_RE = re.compile(r'Start cutting path id: ([^\s\)]+)')
+PATH_END_RE = re.compile(r'End cutting path id: ')
+
+
+class GCodeBuffer(object):
+    """
+        Collects G-code lines in chunks instead of one growing string.
+        If stream is given (anything with write()), lines are written to it on every flush,
+        so memory stays bounded by the part of the program not flushed yet.
+        Leading and trailing blank lines are dropped, blank lines in the middle are kept.
+        With compactor (gcode_stream.Compactor) every emitted line is compacted first.
+    """
+    CHUNK_SIZE = 4096
+
+    def __init__(self, stream=None, compactor=None):
+        self.stream = stream
+        self.compactor = compactor
+        self.chunks = []
+        self.current = []
+        self.started = False
+        self.pending_blank = 0
+        self.bytes_written = 0
+
+    def emit(self, *lines):
+        if self.compactor is not None:
+            lines = self.compactor.compact_lines(lines)
+        for line in lines:
+            line = line.lstrip()
+            if not line.strip():
+                if self.started:
+                    self.pending_blank += 1
+                continue
+            if self.pending_blank:
+                self.current.extend([''] * self.pending_blank)
+                self.pending_blank = 0
+            self.current.append(line)
+            self.started = True
+        if len(self.current) >= self.CHUNK_SIZE:
+            self.__close_chunk()
+
+    def __close_chunk(self):
+        if self.current:
+            self.chunks.append('\n'.join(self.current))
+            self.current = []
+
+    def flush(self):
+        """ Writes collected lines to the stream (does nothing without stream) """
+        if self.stream is None:
+            return
+        self.__close_chunk()
+        for chunk in self.chunks:
+            if self.bytes_written:
+                chunk = '\n' + chunk
+            self.stream.write(chunk)
+            self.bytes_written += len(chunk)
+        self.chunks = []
+
+    def getvalue(self):
+        self.__close_chunk()
+        return '\n'.join(self.chunks)
+
+    def write_to(self, f):
+        """ Writes all collected lines to f with a single write call """
+        f.write(self.getvalue())
 
 
 class GCodeWriter(object):
     LASER_ON = 106
     LASER_OFF = 107
+    # streaming formats toolpath in batches (per element it is ~15x slower), a slowly generated
+    # program is still flushed every STREAM_FLUSH_SECONDS so a printer does not wait for it
+    STREAM_FLUSH_ROWS = 1024
+    STREAM_FLUSH_SECONDS = 0.5
 
-    def __init__(self):
-        self.code = ''
+    def __init__(self, stream=None, compact=False, precision=4, resolution_mm=None, modal_motion=False):
+        """
+            stream - optional file-like object. When given, finished elements are written to it once
+            STREAM_FLUSH_ROWS moves are collected or STREAM_FLUSH_SECONDS passed (see open_stream)
+            and save() writes the rest.
+            compact - smaller equivalent output (see gcode_stream.Compactor): unchanged axes and feeds
+            are omitted, positions have precision decimals without trailing zeros (feeds, dwells and powers
+            at least 4). resolution_mm (machine step) overrides precision with the number of decimals it
+            needs. modal_motion omits repeated G0-G3 codes, only for firmware supporting it.
+        """
+        compactor = None
+        if compact:
+            compactor = Compactor(precision if resolution_mm is None else precision_for(resolution_mm), modal_motion)
+        self.buffer = GCodeBuffer(stream, compactor)
+        self.toolpath = Toolpath()
+        self.own_stream = False
         self.type = 'printer'
+        self.__flushed_at = time.time()
+
+    @property
+    def code(self):
+        self._flush_toolpath()
+        return self.buffer.getvalue()
+
+    def open_stream(self, filename):
+        """ Switches writer to streaming mode writing to data/<filename> """
+        self.buffer.stream = open(os.path.join('data', filename), 'w')
+        self.own_stream = True
+        self.buffer.flush()
+
+    def open_serial(self, port, **kwargs):
+        """
+            Switches writer to streaming mode sending finished elements to printer at port
+            (see sender.SerialSender for options), save() waits for the last acknowledgement.
+        """
+        self.buffer.stream = SerialSender(port, **kwargs)
+        self.own_stream = True
+        self.buffer.flush()
+
+    def _emit(self, *lines):
+        self.buffer.emit(*lines)
+
+    def _flush_toolpath(self):
+        """ Formats collected toolpath into G-code text and clears it """
+        if len(self.toolpath):
+            self._emit(*format_toolpath(self.toolpath, self.move_speed, self.pause_before_start_seconds,
+                                        self.LASER_ON, self.LASER_OFF))
+            self.toolpath.clear(keep_templates=True)
 
     def init_laser(self, move_speed=3000, pause_before_start_seconds=0.3, default_z=60, auto_home=True, 
                    left_bottom_corner=[55, 40], default_speed=100, default_power=100, corner_margin=5):
@@ -17,7 +143,15 @@ class GCodeWriter(object):
         """
         self.move_speed = 3000
         self.pause_before_start_seconds = pause_before_start_seconds
-        self.code = 'M{} S0\n\nG90\nG21{}\nG1  Z{:.4f}\n'.format(self.LASER_OFF, '\nG28' if auto_home else '', default_z)
+        compactor = self.buffer.compactor
+        if compactor is not None:
+            compactor = Compactor(compactor.precision, compactor.modal_motion)
+        self.buffer = GCodeBuffer(self.buffer.stream, compactor)
+        self.toolpath = Toolpath()
+        self._emit('M{} S0'.format(self.LASER_OFF), '', 'G90', 'G21')
+        if auto_home:
+            self._emit('G28')
+        self._emit('G1  Z{:.4f}'.format(default_z), '')
         self.default_z = default_z
         self.left_bottom_corner = [v + corner_margin for v in left_bottom_corner]
         self.default_speed = default_speed
@@ -28,38 +162,45 @@ class GCodeWriter(object):
         y += self.left_bottom_corner[1]
         return x, y
 
-    def __move(self, x, y, z=None, absolute=False):
+    def __move(self, x, y, z=None, absolute=False, cmd=CMD_LINE):
         if not absolute:
             x, y = self.__convert_pos(x, y)
-        if z is None:
-            self.code += '\nG1  X{:.4f} Y{:.4f}'.format(x, y)
-        else:
-            self.code += '\nG1  X{:.4f} Y{:.4f} Z{:.4f}'.format(x, y, z)
+        self.toolpath.append(cmd, x, y, z, feed=self.__speed, power=self.__power, laser=True)
 
     def __move_g2(self, x, y, r, absolute=False):
         if not absolute:
             x, y = self.__convert_pos(x, y)
-        self.code += '\nG2  X{:.4f} Y{:.4f} R{:.4f}'.format(x, y, r)
+        self.toolpath.append(CMD_ARC, x, y, r=r, feed=self.__speed, power=self.__power, laser=True)
 
     def __prepare(self, start_point, z_value=None, power=None, speed=None):
         if speed is None:
             speed = self.default_speed
         if power is None:
             power = self.default_power
-        self.code += '\nG1 F{}'.format(self.move_speed)
-        self.__move(*start_point)
+        self.__speed, self.__power = speed, power
+        self.toolpath.begin_element()
+        x, y = self.__convert_pos(*start_point[:2])
+        z = start_point[2] if len(start_point) > 2 else None
+        self.toolpath.append(CMD_TRAVEL, x, y, z, feed=self.move_speed)
         if z_value is not None:
-            self.code += '\nG1  Z{:.4f}'.format(z_value)
-        self.code += '\nG4 P0'
-        self.code += '\nM{} S{}'.format(self.LASER_ON, power)
-        self.code += '\nG4 P{:.4f}'.format(self.pause_before_start_seconds)
-        self.code += '\nG1 F{:.4f}'.format(speed)
+            self.toolpath.append(CMD_Z, x, y, z_value, feed=self.move_speed)
 
     def __element_finished(self):
-        self.code += '\nG4 P0\nM{} S0'.format(self.LASER_OFF)
+        if self.buffer.stream is None:
+            return
+        now = time.time()
+        if len(self.toolpath) >= self.STREAM_FLUSH_ROWS or now - self.__flushed_at >= self.STREAM_FLUSH_SECONDS:
+            self._flush_toolpath()
+            self.buffer.flush()
+            self.__flushed_at = now
 
-    def draw_path(self, points, **kwargs):
-        self.__prepare(points[-1], **kwargs)
+    def draw_path(self, points, closed=True, **kwargs):
+        """ closed - path starts at the last point, so the segment back to the first one is burnt too """
+        if closed:
+            self.__prepare(points[-1], **kwargs)
+        else:
+            self.__prepare(points[0], **kwargs)
+            points = points[1:]
         for p in points:
             self.__move(*p)
         self.__element_finished()
@@ -87,89 +228,149 @@ class GCodeWriter(object):
         self.__move(*b)
         self.__element_finished()
 
-    def __parse_move_line(self, line):
+    def draw_power_path(self, points, powers, **kwargs):
+        """
+            Open path burnt with power changing along it: powers[i] is used from points[i] to points[i+1].
+            Power changes are written as M106 S<power> between the moves.
+        """
+        assert len(powers) == len(points) - 1
+        self.__prepare(points[0], **kwargs)
+        xs, ys = self.__convert_pos(np.asarray([p[0] for p in points[1:]], dtype=float),
+                                    np.asarray([p[1] for p in points[1:]], dtype=float))
+        self.toolpath.append_many(CMD_LINE, xs, ys, feed=self.__speed, power=powers, laser=True)
+        self.__element_finished()
+
+    @staticmethod
+    def __parse_move_line(line):
         """G02 X88.704067 Y251.364508 Z-0.125000 I0.032899 J0.064154"""
-        parts = re.sub('\(.*?\)', '', line).split()
-        x, y = None, None
-        for part in parts[:0:-1]:
-            axis = part.upper()[0]
-            value = float(part[1:])
-            if axis in ['Z', 'F']:
-                parts.remove(part)
-            elif axis == 'X':
-                x = value
-                parts.remove(part)
+        parts = COMMENT_RE.sub('', line).split()
+        x, y, rest = None, None, []
+        for part in parts[1:]:
+            axis = part[0].upper()
+            if axis == 'X':
+                if x is None:
+                    x = float(part[1:])
             elif axis == 'Y':
-                y = value
-                parts.remove(part)
+                if y is None:
+                    y = float(part[1:])
+            elif axis not in 'ZF':
+                rest.append(part)
         if x is None or y is None:
             return None
-        template = parts[0] + ' X{:.6f} Y{:.6f} ' + ' '.join(parts[1:])
-        return [template, x, y]
-
+        return parts[0] + ' X{:.6f} Y{:.6f} ' + ' '.join(rest), x, y
 
     def load_from_inkscape_gcode(self, filename, w, cx, cy, **kwargs):
         """
             Loads path created in inkscape using (Extensions > Gcode tools > Path to GCode)
+            File is read line by line, only coordinates (and distinct move templates) are kept in memory.
         """
-        lines = [x.strip() for x in open(filename).read().split('\n')]
-        xs, ys = [], []
-        shapes = dict()
-        current_path = None
-        for line in lines:
-            path_start = re.search('Start cutting path id: ([^\s\)]+)', line)
-            path_end = re.search('End cutting path id: ', line)
-            if path_start is not None:
-                current_path = path_start.group(1)
-                shapes[current_path] = []
-            elif path_end is not None:
-                current_path = None
-            elif line.startswith('('):
-                continue
-            elif line.upper().startswith('G'):
-                if current_path is not None:
-                    x = self.__parse_move_line(line)
-                    if x is not None:
-                        shapes[current_path].append(x)
-                        xs.append(x[1])
-                        ys.append(x[2])
-        min_x, max_x, min_y, max_y = min(xs), max(xs), min(ys), max(ys)
-        
+        started = time.time()
+        shapes = dict()  # path id -> (xs, ys, template ids)
+        templates = dict()
+        current = None
+        min_x = min_y = float('inf')
+        max_x = max_y = -float('inf')
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('('):
+                    path_start = PATH_START_RE.search(line)
+                    if path_start is not None:
+                        current = shapes[path_start.group(1)] = (array('d'), array('d'), array('i'))
+                    elif PATH_END_RE.search(line) is not None:
+                        current = None
+                elif current is not None and line[:1] in ('G', 'g'):
+                    move = self.__parse_move_line(line)
+                    if move is not None:
+                        template, x, y = move
+                        current[0].append(x)
+                        current[1].append(y)
+                        current[2].append(templates.setdefault(template, len(templates)))
+                        min_x, max_x = min(min_x, x), max(max_x, x)
+                        min_y, max_y = min(min_y, y), max(max_y, y)
+
         scale = w/(max_x - min_x)
         dx, dy = (max_x + min_x)/2, (max_y + min_y)/2
         cx += self.left_bottom_corner[0]
         cy += self.left_bottom_corner[1]
-        print(scale, dx, dy, cx, cy, min_x, max_x)
-
-        for item in sorted(shapes.values(), key= lambda x: x[0][1]):
-            self.code += '\n'
-            for i, (template, x, y) in enumerate(item):
-                x = (x - dx)*scale + cx
-                y = (y - dy)*scale + cy
-                if i == 0:
-                    self.__prepare([x - self.left_bottom_corner[0], y - self.left_bottom_corner[1]], **kwargs)
-                else:
-                    self.code += '\n' + template.format(x, y)
+        template_ids = np.array([self.toolpath.add_template(t) for t in templates], dtype=np.int32)
+
+        moves = 0
+        for xs, ys, ts in sorted((s for s in shapes.values() if len(s[0])), key=lambda s: s[0][0]):
+            xs = (np.frombuffer(xs) - dx)*scale + cx
+            ys = (np.frombuffer(ys) - dy)*scale + cy
+            self.__prepare([xs[0] - self.left_bottom_corner[0], ys[0] - self.left_bottom_corner[1]], **kwargs)
+            self.toolpath.append_many(CMD_RAW, xs[1:], ys[1:], feed=self.__speed, power=self.__power, laser=True,
+                                      template=template_ids[np.frombuffer(ts, dtype=np.int32)[1:]])
             self.__element_finished()
+            moves += len(xs)
+        elapsed = max(time.time() - started, 1e-9)
+        print("Loaded {} paths, {} moves from {} ({:.1f} MB/s)".format(
+            len(shapes), moves, filename, os.path.getsize(filename) / elapsed / 2**20))
+
+    def optimize_travel(self, **kwargs):
+        """
+            Reorders collected elements to shorten laser-off moves, see optimizer.optimize_travel for options.
+            Does nothing in streaming mode, elements are already written there.
+        """
+        stats = optimizer.optimize_travel(self.toolpath, **kwargs)
+        print("Travel distance: {:.1f} mm -> {:.1f} mm ({} elements)".format(
+            stats['travel_before'], stats['travel_after'], stats['elements']))
+        return stats
+
+    def merge_paths(self, tolerance=1e-3, **kwargs):
+        """
+            Joins touching elements into continuous paths, see optimizer.merge_paths.
+            Every removed element saves one laser-on dwell and its feed changes.
+        """
+        stats = optimizer.merge_paths(self.toolpath, tolerance=tolerance, **kwargs)
+        stats['dwell_saved'] = (stats['elements_before'] - stats['elements_after']) * self.pause_before_start_seconds
+        print("Elements: {} -> {}, moves: {} -> {}, dwell saved: {:.1f} s".format(
+            stats['elements_before'], stats['elements_after'], stats['rows_before'], stats['rows_after'],
+            stats['dwell_saved']))
+        return stats
+
+    def estimate(self, **kwargs):
+        """
+            Estimates run time of the program collected so far (see estimator.estimate for options).
+            In streaming mode only the part not written yet is counted.
+        """
+        lines = self.buffer.getvalue().split('\n')
+        for line in format_toolpath(self.toolpath, self.move_speed, self.pause_before_start_seconds,
+                                    self.LASER_ON, self.LASER_OFF):
+            lines.extend(line.split('\n'))
+        stats = estimator.estimate(parse(lines), **kwargs)
+        print(estimator.format_estimate(stats))
+        return stats
+
+    def save_preview(self, filename, dpi=200, travel=True):
+        """
+            Writes PNG preview of collected toolpath (burn black, travel red), works without GUI.
+            Call it before save(), in streaming mode only elements not written yet are drawn.
+        """
+        cv2.imwrite(filename, preview.render_toolpath(self.toolpath, dpi, travel))
 
     def __finalize(self):
-        self.code += '\nG1 F{}'.format(self.move_speed)
-        self.__move(0, 0, absolute=True)
-        lines = self.code.split('\n')
-        lines = [x.lstrip() for x in lines]
-        while lines[0].strip() == '':
-            lines.pop(0)
-        while lines[-1].strip() == '':
-            lines.pop()
-        self.code = '\n'.join(lines)
-
-    def save(self, filename):
+        self._flush_toolpath()
+        self._emit('G1 F{}'.format(self.move_speed), 'G1  X{:.4f} Y{:.4f}'.format(0, 0))
+        if self.buffer.compactor is not None:
+            print(self.buffer.compactor.report())
+
+    def save(self, filename=None):
+        """ In streaming mode filename is ignored, the rest of the program goes to the stream """
         self.__finalize()
+        if self.buffer.stream is not None:
+            self.buffer.flush()
+            if self.own_stream:
+                self.buffer.stream.close()
+                self.buffer.stream = None
+                self.own_stream = False
+            print("Stream finished, {} bytes written.".format(self.buffer.bytes_written))
+            return
         with open(os.path.join('data', filename), 'w') as f:
-            f.write(self.code)
+            self.buffer.write_to(f)
             print("File {} saved successfully.".format(filename))
 
-
 if __name__ == "__main__":
     gcode = GCodeWriter()
     gcode.init_laser(left_bottom_corner=[55, 40], default_z=71.2, default_speed=700, default_power=100)
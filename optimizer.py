@@ -0,0 +1,333 @@
+import numpy as np
+from toolpath import CMD_TRAVEL, CMD_LINE
+
+
+def element_bounds(data):
+    """ Returns (starts, ends) row indices of every element, ends are exclusive """
+    if len(data) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    starts = np.flatnonzero(np.append(True, data['element'][1:] != data['element'][:-1]))
+    ends = np.append(starts[1:], len(data))
+    return starts, ends
+
+
+def _endpoints(data, starts, ends):
+    first = np.stack((data['x'][starts], data['y'][starts]), axis=1)
+    last = np.stack((data['x'][ends - 1], data['y'][ends - 1]), axis=1)
+    return first, last
+
+
+def travel_distance(data, origin=(0, 0)):
+    """ Length of all laser-off moves: origin -> elements -> origin """
+    starts, ends = element_bounds(data)
+    if len(starts) == 0:
+        return 0.
+    first, last = _endpoints(data, starts, ends)
+    origin = np.array(origin, dtype=float)[None]
+    froms = np.concatenate((origin, last))
+    tos = np.concatenate((first, origin))
+    return float(np.sqrt(((tos - froms)**2).sum(axis=1)).sum())
+
+
+def _reversible(data, starts, ends):
+    res = np.zeros(len(starts), dtype=bool)
+    for i, (s, e) in enumerate(zip(starts.tolist(), ends.tolist())):
+        rows = data[s:e]
+        res[i] = (rows['cmd'][rows['laser']] == CMD_LINE).all()
+    return res
+
+
+def _reverse_element(rows):
+    """ Returns copy of element rows passing the same points in opposite direction """
+    rows = rows.copy()
+    on = rows['laser']
+    xs = np.append(rows['x'][0], rows['x'][on])[::-1]
+    ys = np.append(rows['y'][0], rows['y'][on])[::-1]
+    zs = np.append(rows['z'][0], rows['z'][on])[::-1]
+    rows['x'][~on], rows['y'][~on] = xs[0], ys[0]
+    rows['z'][0] = zs[0]
+    rows['x'][on], rows['y'][on], rows['z'][on] = xs[1:], ys[1:], zs[1:]
+    # every laser row keeps feed and power of the segment it ends, so they are reversed with the points
+    rows['feed'][on], rows['power'][on] = rows['feed'][on][::-1], rows['power'][on][::-1]
+    return rows
+
+
+class _GridIndex(object):
+    """ Uniform grid over element endpoints for nearest-neighbour queries """
+    def __init__(self, points, cell_size):
+        self.points = points
+        self.cell_size = cell_size
+        self.cells = dict()
+        keys = np.floor(points / cell_size).astype(int)
+        for i, key in enumerate(map(tuple, keys.tolist())):
+            self.cells.setdefault(key, []).append(i)
+        self.min_key = keys.min(axis=0)
+        self.max_key = keys.max(axis=0)
+
+    def nearest(self, p, alive):
+        cx, cy = int(np.floor(p[0] / self.cell_size)), int(np.floor(p[1] / self.cell_size))
+        max_ring = int(max(abs(cx - self.min_key[0]), abs(cx - self.max_key[0]),
+                           abs(cy - self.min_key[1]), abs(cy - self.max_key[1])))
+        best, best_d = None, np.inf
+        for ring in range(max_ring + 1):
+            if best is not None and best_d <= ((ring - 1) * self.cell_size)**2:
+                break
+            for key in self.__ring(cx, cy, ring):
+                items = self.cells.get(key)
+                if not items:
+                    continue
+                items[:] = [i for i in items if alive(i)]
+                for i in items:
+                    d = (self.points[i, 0] - p[0])**2 + (self.points[i, 1] - p[1])**2
+                    if d < best_d:
+                        best, best_d = i, d
+        return best
+
+    @staticmethod
+    def __ring(cx, cy, ring):
+        if ring == 0:
+            yield cx, cy
+            return
+        for dx in range(-ring, ring + 1):
+            yield cx + dx, cy - ring
+            yield cx + dx, cy + ring
+        for dy in range(-ring + 1, ring):
+            yield cx - ring, cy + dy
+            yield cx + ring, cy + dy
+
+
+def _greedy_order(first, last, reversible, origin, cell_size):
+    n = len(first)
+    # endpoint i < n is start of element i, endpoint i >= n is end of element i - n (entering it reversed)
+    points = np.concatenate((first, last))
+    index = _GridIndex(points, cell_size)
+    used = np.zeros(n, dtype=bool)
+
+    def alive(i):
+        return not used[i % n] and (i < n or reversible[i - n])
+
+    order, flipped = [], []
+    p = np.array(origin, dtype=float)
+    for _ in range(n):
+        i = index.nearest(p, alive)
+        k, flip = i % n, i >= n
+        used[k] = True
+        order.append(k)
+        flipped.append(flip)
+        p = first[k] if flip else last[k]
+    return np.array(order, dtype=int), np.array(flipped, dtype=bool)
+
+
+def _two_opt(order, flipped, first, last, reversible, origin, window, max_passes):
+    """ Reverses runs of reversible elements while it shortens the travel """
+    order, flipped = order.copy(), flipped.copy()
+    origin = np.array(origin, dtype=float)
+    n = len(order)
+
+    def start(k):
+        return last[order[k]] if flipped[k] else first[order[k]]
+
+    def end(k):
+        return first[order[k]] if flipped[k] else last[order[k]]
+
+    def dist(a, b):
+        return np.sqrt(((a - b)**2).sum())
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n):
+            if not reversible[order[i]]:
+                continue
+            before = end(i - 1) if i > 0 else origin
+            for j in range(i, min(n, i + window)):
+                if not reversible[order[j]]:
+                    break
+                after = start(j + 1) if j + 1 < n else origin
+                delta = dist(before, end(j)) + dist(start(i), after) - dist(before, start(i)) - dist(end(j), after)
+                if delta < -1e-9:
+                    order[i:j+1] = order[i:j+1][::-1]
+                    flipped[i:j+1] = ~flipped[i:j+1][::-1]
+                    improved = True
+        if not improved:
+            break
+    return order, flipped
+
+
+def optimize_travel(toolpath, reverse=True, two_opt=False, two_opt_window=50, two_opt_passes=3,
+                    origin=(0, 0), cell_size=None):
+    """
+        Reorders elements of toolpath in place to shorten laser-off travel.
+        Greedy nearest neighbour over a grid index, elements made of straight moves only may be
+        burnt in opposite direction (reverse=True), optional 2-opt refinement on top of it.
+        Returns dict with travel distance before and after.
+    """
+    data = toolpath.data
+    before = travel_distance(data, origin)
+    starts, ends = element_bounds(data)
+    n = len(starts)
+    if n < 2:
+        return {'elements': n, 'travel_before': before, 'travel_after': before}
+
+    first, last = _endpoints(data, starts, ends)
+    reversible = _reversible(data, starts, ends) if reverse else np.zeros(n, dtype=bool)
+    if cell_size is None:
+        points = np.concatenate((first, last))
+        extent = np.maximum(points.max(axis=0) - points.min(axis=0), 1e-6)
+        cell_size = max(np.sqrt(extent[0] * extent[1] / n), extent.max() / 1000.)
+    order, flipped = _greedy_order(first, last, reversible, origin, cell_size)
+    if two_opt:
+        order, flipped = _two_opt(order, flipped, first, last, reversible, origin, two_opt_window, two_opt_passes)
+
+    parts = []
+    for new_i, (k, flip) in enumerate(zip(order.tolist(), flipped.tolist())):
+        rows = data[starts[k]:ends[k]]
+        rows = _reverse_element(rows) if flip else rows.copy()
+        rows['element'] = new_i
+        parts.append(rows)
+    optimized = np.concatenate(parts)
+    after = travel_distance(optimized, origin)
+    if after < before:
+        data[:] = optimized
+    else:
+        after = before
+    return {'elements': n, 'travel_before': before, 'travel_after': after}
+
+
+def _mergeable(data, starts, ends):
+    """ Elements with straight laser moves of one power only and without separate Z change """
+    res = np.zeros(len(starts), dtype=bool)
+    for i, (s, e) in enumerate(zip(starts.tolist(), ends.tolist())):
+        cmd, power = data['cmd'][s:e], data['power'][s + 1:e]
+        res[i] = cmd[0] == CMD_TRAVEL and (cmd[1:] == CMD_LINE).all() and (power == power[:1]).all()
+    return res
+
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    """ Distances of points (px, py) from segment a-b """
+    dx, dy = bx - ax, by - ay
+    t = np.clip(((px - ax) * dx + (py - ay) * dy) / np.maximum(dx * dx + dy * dy, 1e-24), 0, 1)
+    return np.hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+def _drop_collinear(rows, tolerance):
+    """
+        Removes laser-on points whose removal moves the burnt line at most tolerance (Douglas-Peucker
+        between points that must stay: ends, Z changes and feed or power changes)
+    """
+    if len(rows) < 3:
+        return rows
+    x, y, z = rows['x'], rows['y'], rows['z']
+    laser, feed, power = rows['laser'], rows['feed'], rows['power']
+    keep = np.ones(len(rows), dtype=bool)
+    keep[1:-1] = ~(laser[1:-1] & laser[2:] & np.isnan(z[1:-1]) & np.isnan(z[2:]) &
+                   (feed[1:-1] == feed[2:]) & (power[1:-1] == power[2:]))
+    fixed = np.flatnonzero(keep).tolist()
+    stack = [(a, b) for a, b in zip(fixed[:-1], fixed[1:]) if b - a > 1]
+    while stack:
+        a, b = stack.pop()
+        dist = _segment_distance(x[a + 1:b], y[a + 1:b], x[a], y[a], x[b], y[b])
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            m = a + 1 + i
+            keep[m] = True
+            stack.extend(pair for pair in ((a, m), (m, b)) if pair[1] - pair[0] > 1)
+    return rows[keep]
+
+
+def merge_paths(toolpath, tolerance=1e-3, collinear=True):
+    """
+        Joins elements whose start is within tolerance from the end of previous one into single
+        continuous laser-on elements (one travel, one laser-on dwell each), then drops intermediate
+        points that are within tolerance from the simplified line (see burnt_deviation). Only elements of straight moves with the same feed and power are joined,
+        they may be reversed to fit. Gaps up to tolerance are burnt.
+        Returns dict with element counts before and after.
+    """
+    data = toolpath.data
+    starts, ends = element_bounds(data)
+    n = len(starts)
+    if n < 2:
+        return {'elements_before': n, 'elements_after': n, 'rows_before': len(data), 'rows_after': len(data)}
+    first, last = _endpoints(data, starts, ends)
+    mergeable = _mergeable(data, starts, ends)
+    key_size = max(tolerance, 1e-9)
+
+    # index of element endpoints: (cell) -> [endpoint ids], id < n is start, id >= n is end
+    cells = dict()
+    for i in np.flatnonzero(mergeable).tolist():
+        for pid, p in ((i, first[i]), (i + n, last[i])):
+            cells.setdefault((int(p[0] // key_size), int(p[1] // key_size)), []).append(pid)
+    used = np.zeros(n, dtype=bool)
+
+    def find_next(k, p):
+        cx, cy = int(p[0] // key_size), int(p[1] // key_size)
+        feed, power = data['feed'][ends[k] - 1], data['power'][ends[k] - 1]
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for pid in cells.get((cx + dx, cy + dy), []):
+                    j = pid % n
+                    q = first[j] if pid < n else last[j]
+                    if (not used[j] and abs(q[0] - p[0]) <= tolerance and abs(q[1] - p[1]) <= tolerance and
+                            data['feed'][ends[j] - 1] == feed and data['power'][ends[j] - 1] == power):
+                        return j, pid >= n
+        return None, False
+
+    parts = []
+    for k in range(n):
+        if used[k]:
+            continue
+        used[k] = True
+        head = k
+        chain = [data[starts[k]:ends[k]].copy()]
+        if mergeable[k]:
+            p = last[k]
+            while True:
+                j, flip = find_next(k, p)
+                if j is None:
+                    break
+                used[j] = True
+                rows = data[starts[j]:ends[j]]
+                rows = _reverse_element(rows) if flip else rows.copy()
+                prev = chain[-1][-1]
+                same_point = prev['x'] == rows['x'][0] and prev['y'] == rows['y'][0] and np.isnan(rows['z'][0])
+                rows = rows[1:] if same_point else rows
+                if not same_point:
+                    rows['cmd'][0], rows['laser'][0] = CMD_LINE, True
+                    rows['feed'][0], rows['power'][0] = rows['feed'][-1], rows['power'][-1]
+                chain.append(rows)
+                k, p = j, (first[j] if flip else last[j])
+        rows = np.concatenate(chain)
+        if collinear and mergeable[head]:
+            rows = _drop_collinear(rows, tolerance)
+        rows['element'] = len(parts)
+        parts.append(rows)
+    merged = np.concatenate(parts)
+    stats = {'elements_before': n, 'elements_after': len(parts), 'rows_before': len(data), 'rows_after': len(merged)}
+    toolpath.size = 0
+    toolpath.element_count = 0
+    toolpath.extend(merged)
+    return stats
+
+
+def _burnt_segments(data):
+    """ (x1, y1, x2, y2) of every laser-on move, arcs as chords """
+    on = np.flatnonzero(data['laser'][1:] & (data['element'][1:] == data['element'][:-1])) + 1
+    return np.stack((data['x'][on - 1], data['y'][on - 1], data['x'][on], data['y'][on]), axis=1)
+
+
+def burnt_deviation(before, after, chunk=1024):
+    """
+        Largest distance of a burnt point of toolpath data before from the burnt moves after
+        (quadratic, meant for checking merge_paths on test jobs)
+    """
+    old, new = _burnt_segments(before), _burnt_segments(after)
+    points = np.unique(np.concatenate((old[:, :2], old[:, 2:])), axis=0)
+    if not len(points):
+        return 0.
+    if not len(new):
+        return float('inf')
+    res = 0.
+    for i in range(0, len(points), chunk):
+        px, py = points[i:i + chunk, :1], points[i:i + chunk, 1:]
+        dist = _segment_distance(px, py, *(new[None, :, k] for k in range(4)))
+        res = max(res, float(dist.min(axis=1).max()))
+    return res
@@ -1,5 +1,6 @@
 from lib import GCodeWriter
 from image_processing.scan import ScanImageWriter
+from image_processing.cache import ResultCache
 
 gcode = GCodeWriter()
 gcode.init_laser(left_bottom_corner=[55, 40], default_z=71.2, default_speed=700, default_power=100)
@@ -31,8 +32,10 @@ def full_desk_image_3_step(path):
     gcode = GCodeWriter()
     gcode.init_laser(left_bottom_corner=[15-9.3, 65-4], default_z=67.2, default_speed=500, default_power=100)
     im = ScanImageWriter(gcode)
+    im.set_cache(ResultCache())
     im.set_image(path, 3)
     im.set_width(149)
     im.process(distance_mm=1)
     im.render()
+    gcode.optimize_travel()
     im.save('image-sto.gcode')
\ No newline at end of file
@@ -0,0 +1,77 @@
+import numpy as np
+import cv2
+from toolpath import CMD_ARC
+from optimizer import element_bounds
+
+BURN_COLOR = (0, 0, 0)
+TRAVEL_COLOR = (0, 0, 255)
+
+
+def _arc_points(x0, y0, x1, y1, r, steps=16):
+    """ Points of clockwise G2 arc with radius r (shorter arc) from (x0, y0) to (x1, y1) """
+    chord = np.hypot(x1 - x0, y1 - y0)
+    if chord == 0 or r <= 0:
+        return np.array([[x1, y1]])
+    mx, my = (x0 + x1) / 2, (y0 + y1) / 2
+    h = np.sqrt(max(r*r - chord*chord/4, 0))
+    # center lies to the right of the chord direction for clockwise arc
+    cx, cy = mx + h * (y1 - y0) / chord, my - h * (x1 - x0) / chord
+    a0, a1 = np.arctan2(y0 - cy, x0 - cx), np.arctan2(y1 - cy, x1 - cx)
+    if a1 > a0:
+        a1 -= 2 * np.pi
+    angles = np.linspace(a0, a1, steps + 1)[1:]
+    return np.stack((cx + r * np.cos(angles), cy + r * np.sin(angles)), axis=1)
+
+
+def render_lines(lines, size, pixels_in_unit, image=None, color=0):
+    """ Draws (N, 4) array of x1, y1, x2, y2 lines with one polylines call, returns the image """
+    w, h = size
+    if image is None:
+        image = np.full((int(h * pixels_in_unit), int(w * pixels_in_unit)), 255, dtype=np.uint8)
+    if len(lines):
+        pts = (np.asarray(lines, dtype=float).reshape(-1, 2, 2) * pixels_in_unit).astype(np.int32)
+        cv2.polylines(image, list(pts), False, color, 1)
+    return image
+
+
+def render_toolpath(toolpath, dpi=200, travel=True, margin_mm=5):
+    """
+        Renders toolpath as seen from above (Y up): burnt moves black, travel moves red.
+        Returns BGR image.
+    """
+    data = toolpath.data
+    scale = dpi / 25.4
+    if len(data) == 0:
+        return np.full((1, 1, 3), 255, dtype=np.uint8)
+    min_x, min_y = data['x'].min() - margin_mm, data['y'].min() - margin_mm
+    max_x, max_y = data['x'].max() + margin_mm, data['y'].max() + margin_mm
+    image = np.full((int((max_y - min_y) * scale) + 1, int((max_x - min_x) * scale) + 1, 3), 255, dtype=np.uint8)
+
+    def to_pixels(points):
+        points = np.asarray(points, dtype=float)
+        return np.stack(((points[:, 0] - min_x) * scale, (max_y - points[:, 1]) * scale), axis=1).astype(np.int32)
+
+    # element is drawn through its first point and burning rows, only elements with arcs go row by row
+    starts, ends = element_bounds(data)
+    keep = data['laser'].astype(bool)
+    keep[starts] = True
+    kept = np.flatnonzero(keep)
+    pixels = to_pixels(np.stack((data['x'][kept], data['y'][kept]), axis=1))
+    burns = np.split(pixels, np.searchsorted(kept, starts[1:]))
+    lasts = pixels[np.searchsorted(kept, ends) - 1]
+    arc_rows = np.flatnonzero(data['cmd'] == CMD_ARC)
+    for i in np.unique(np.searchsorted(starts, arc_rows, side='right') - 1).tolist():
+        rows = data[starts[i]:ends[i]]
+        points = [(rows['x'][0], rows['y'][0])]
+        for row in rows[1:]:
+            if row['cmd'] == CMD_ARC:
+                points.extend(_arc_points(points[-1][0], points[-1][1], row['x'], row['y'], row['r']).tolist())
+            elif row['laser']:
+                points.append((row['x'], row['y']))
+        burns[i] = to_pixels(points)
+        lasts[i] = burns[i][-1]
+    travels = list(np.stack((lasts[:-1], pixels[np.searchsorted(kept, starts[1:])]), axis=1))
+    if travel and travels:
+        cv2.polylines(image, travels, False, TRAVEL_COLOR, 1)
+    cv2.polylines(image, burns, False, BURN_COLOR, 1)
+    return image
@@ -0,0 +1,310 @@
+import os
+import sys
+import time
+import select
+import threading
+from collections import deque
+from gcode_stream import COMMENT_RE
+
+try:
+    import termios
+    import tty
+except ImportError:  # not POSIX, pyserial is used instead
+    termios = None
+try:
+    import serial
+except ImportError:
+    serial = None
+
+
+class _TtyPort(object):
+    """ Serial port through os-level tty access (POSIX), raw 8N1 """
+    def __init__(self, path, baudrate):
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+        attrs = termios.tcgetattr(self.fd)
+        attrs[4] = attrs[5] = getattr(termios, 'B{}'.format(baudrate))
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+
+    def write(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def read(self, timeout):
+        """ Returns available bytes, b'' after timeout seconds without data """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return b''
+        return os.read(self.fd, 4096)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _PySerialPort(object):
+    def __init__(self, path, baudrate):
+        self.serial = serial.Serial(path, baudrate)
+
+    def write(self, data):
+        self.serial.write(data)
+
+    def read(self, timeout):
+        self.serial.timeout = timeout
+        return self.serial.read(max(1, self.serial.in_waiting))
+
+    def close(self):
+        self.serial.close()
+
+
+def open_port(path, baudrate=115200):
+    """ termios for standard baudrates, pyserial otherwise (e.g. 250000, common for Marlin) """
+    if termios is not None and hasattr(termios, 'B{}'.format(baudrate)):
+        return _TtyPort(path, baudrate)
+    if serial is None:
+        raise ValueError("Baudrate {} needs pyserial (pip install pyserial)".format(baudrate) if termios is not None
+                         else "Serial ports need pyserial on this platform")
+    return _PySerialPort(path, baudrate)
+
+
+def checksum(line):
+    """ XOR of all characters, as checked by Marlin/RepRap firmware """
+    res = 0
+    for c in line.encode():
+        res ^= c
+    return res
+
+
+class SerialSender(object):
+    """
+        File-like sink sending G-code to firmware as it is written, e.g. GCodeWriter(stream=SerialSender(...))
+        or GCodeWriter.open_serial. Every write() must contain whole lines (GCodeBuffer.flush does so).
+        Flow control: a line is sent only while fewer than max_in_flight lines (and, if max_bytes is given,
+        fewer bytes - character counting for GRBL-like receive buffers) are waiting for their "ok".
+        line_numbers adds N and checksum to every line, so "Resend: N" requests can be served from history.
+        Opening the port resets most Arduino-based boards, so nothing is sent before the firmware
+        banner ("start" or "Grbl ...") arrives or startup_seconds pass.
+    """
+    STARTUP_BANNERS = ('start', 'grbl')
+
+    def __init__(self, port, baudrate=115200, max_in_flight=4, max_bytes=None, line_numbers=False,
+                 timeout=60., history=1000, startup_seconds=3.):
+        """
+            port - device path or opened port object with write(bytes), read(timeout) and close()
+            startup_seconds - longest wait for the banner, 0 for boards that do not reset
+        """
+        self.own_port = isinstance(port, str)
+        self.port = open_port(port, baudrate) if self.own_port else port
+        self.max_in_flight = max_in_flight
+        self.max_bytes = max_bytes
+        self.line_numbers = line_numbers
+        self.timeout = timeout
+        self.in_flight = deque()    # byte sizes of lines waiting for "ok"
+        self.history = deque(maxlen=history)    # (number, line) for resends
+        self.received = b''
+        self.errors = []
+        self.lines_sent = 0
+        self.resent = 0
+        self.bytes_sent = 0
+        self.max_in_flight_seen = 0
+        self.started = time.time()
+        self.first_line_time = None
+        self.__line_number = 0
+        self.__resend_from = None
+        self.__wait_startup(startup_seconds)
+        if line_numbers:
+            self.__send_line('M110 N0', 0)
+            self.__line_number = 1
+
+    def __wait_startup(self, seconds):
+        """ Skips boot messages until the banner line, gives up after seconds """
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            while b'\n' in self.received:
+                line, self.received = self.received.split(b'\n', 1)
+                if line.decode(errors='replace').strip().lower().startswith(self.STARTUP_BANNERS):
+                    return
+            self.received += self.port.read(max(0., deadline - time.time()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, text):
+        for line in text.split('\n'):
+            line = COMMENT_RE.sub('', line).strip()
+            if line:
+                self.__send(line)
+
+    def flush(self):
+        pass
+
+    def __send(self, line):
+        if self.__resend_from is not None:
+            self.__serve_resend()
+        if self.line_numbers:
+            number = self.__line_number
+            self.__line_number += 1
+            self.history.append((number, line))
+            self.__send_line(line, number)
+        else:
+            self.__send_line(line)
+
+    def __send_line(self, line, number=None):
+        if number is not None:
+            line = 'N{} {}'.format(number, line)
+            line = '{}*{}'.format(line, checksum(line))
+        data = (line + '\n').encode()
+        while self.in_flight and (len(self.in_flight) >= self.max_in_flight or
+                                  (self.max_bytes is not None and sum(self.in_flight) + len(data) > self.max_bytes)):
+            self.__handle_reply(self.__read_reply())
+        self.port.write(data)
+        self.in_flight.append(len(data))
+        self.lines_sent += 1
+        self.bytes_sent += len(data)
+        self.max_in_flight_seen = max(self.max_in_flight_seen, len(self.in_flight))
+        if self.first_line_time is None:
+            self.first_line_time = time.time() - self.started
+
+    def __read_reply(self):
+        deadline = time.time() + self.timeout
+        while b'\n' not in self.received:
+            chunk = self.port.read(max(0., deadline - time.time()))
+            if not chunk and time.time() >= deadline:
+                raise IOError("No reply from firmware in {} s ({} lines waiting)".format(
+                    self.timeout, len(self.in_flight)))
+            self.received += chunk
+        line, self.received = self.received.split(b'\n', 1)
+        return line.decode(errors='replace').strip()
+
+    def __handle_reply(self, reply):
+        lower = reply.lower()
+        if lower.startswith('ok'):
+            if self.in_flight:
+                self.in_flight.popleft()
+        elif lower.startswith('resend:') or lower.startswith('rs '):
+            assert self.line_numbers, "Resend requested, but lines are sent without numbers"
+            number = int(reply.split(':' if ':' in reply else ' ', 1)[1].split()[0])
+            if self.__resend_from is None or number < self.__resend_from:
+                self.__resend_from = number
+        elif lower.startswith('error') or lower.startswith('!!'):
+            self.errors.append(reply)
+            print("Firmware: {}".format(reply))
+            if lower.startswith('!!'):
+                raise IOError("Firmware halted: {}".format(reply))
+
+    def __serve_resend(self):
+        """
+            Firmware rejects (still with "ok") every line after the broken one, so once all lines
+            in flight are answered the history from the requested line on is sent again
+        """
+        while self.__resend_from is not None:
+            while self.in_flight:
+                self.__handle_reply(self.__read_reply())
+            number, self.__resend_from = self.__resend_from, None
+            lines = [(n, line) for n, line in self.history if n >= number]
+            assert lines and lines[0][0] == number, "Line {} is not in resend history anymore".format(number)
+            self.resent += len(lines)
+            for n, line in lines:
+                self.__send_line(line, n)
+
+    def wait(self):
+        """ Blocks until all sent lines are acknowledged """
+        while self.in_flight or self.__resend_from is not None:
+            if self.__resend_from is not None:
+                self.__serve_resend()
+            else:
+                self.__handle_reply(self.__read_reply())
+
+    def close(self):
+        self.wait()
+        if self.own_port:
+            self.port.close()
+        print("Sent {} lines ({} bytes, {} resent) in {:.1f} s, first line after {:.2f} s, "
+              "up to {} lines in flight".format(self.lines_sent, self.bytes_sent, self.resent,
+                                                time.time() - self.started, self.first_line_time or 0,
+                                                self.max_in_flight_seen))
+
+
+class FirmwareStandIn(threading.Thread):
+    """
+        Pseudo-terminal firmware for dry runs: answers "ok" to every line after it spent line_seconds
+        "executing" it, keeping at most buffer_lines queued. Received lines are collected in self.lines.
+        Numbered lines are checked like Marlin does, corrupt_every > 0 fails checksum of every such line.
+        The sender connects to self.port_path, "start" is sent first like Marlin does after reset.
+    """
+    def __init__(self, line_seconds=0., buffer_lines=4, corrupt_every=0):
+        super().__init__(daemon=True)
+        self.master, slave = os.openpty()
+        self.port_path = os.ttyname(slave)
+        self.__slave = slave
+        tty.setraw(slave)  # no echo of the banner before the sender opens the port
+        self.line_seconds = line_seconds
+        self.buffer_lines = buffer_lines
+        self.lines = []
+        self.overflows = 0
+        self.corrupt_every = corrupt_every
+        self.__numbered = 0
+        self.__last_number = None
+        self.__stopped = False
+
+    def run(self):
+        received, pending = b'', deque()
+        os.write(self.master, b'start\n')
+        while not self.__stopped:
+            if select.select([self.master], [], [], 0 if pending else 0.05)[0]:
+                try:
+                    received += os.read(self.master, 4096)
+                except OSError:
+                    break
+                *lines, received = received.split(b'\n')
+                pending.extend(line.decode().strip() for line in lines if line.strip())
+                if len(pending) > self.buffer_lines:
+                    self.overflows += 1
+            if pending:
+                self.__execute(pending.popleft())
+
+    def __reject(self, message):
+        os.write(self.master, '{}, Last Line: {}\nResend: {}\nok\n'.format(
+            message, self.__last_number, self.__last_number + 1).encode())
+
+    def __execute(self, line):
+        if line.startswith('N') and '*' in line:
+            body, cs = line.rsplit('*', 1)
+            number, line = body.split(' ', 1)
+            number = int(number[1:])
+            self.__numbered += 1
+            if line.startswith('M110'):
+                self.__last_number = number
+            elif number != self.__last_number + 1:
+                return self.__reject('Error:Line Number is not Last Line Number+1')
+            elif checksum(body) != int(cs) or (self.corrupt_every and self.__numbered % self.corrupt_every == 0):
+                return self.__reject('Error:checksum mismatch')
+            self.__last_number = number
+        self.lines.append(line)
+        time.sleep(self.line_seconds)
+        os.write(self.master, b'ok\n')
+
+    def stop(self):
+        self.__stopped = True
+        self.join()
+        os.close(self.master)
+        os.close(self.__slave)
+
+
+if __name__ == "__main__":
+    # python sender.py file.gcode [port] - without port the file is sent to FirmwareStandIn
+    path = sys.argv[1]
+    stand_in = None
+    if len(sys.argv) > 2:
+        port = sys.argv[2]
+    else:
+        stand_in = FirmwareStandIn(line_seconds=0.001)
+        stand_in.start()
+        port = stand_in.port_path
+    with open(path) as f, SerialSender(port) as sender:
+        for line in f:
+            sender.write(line)
+    if stand_in is not None:
+        stand_in.stop()
+        print("Stand-in received {} lines, buffer overflows: {}".format(len(stand_in.lines), stand_in.overflows))
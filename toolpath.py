@@ -0,0 +1,141 @@
+import numpy as np
+
+
+CMD_TRAVEL = 0  # laser-off move to the element start (G1 X Y [Z])
+CMD_Z = 1       # laser-off Z change before the laser is turned on (G1 Z)
+CMD_LINE = 2    # laser-on linear move (G1 X Y [Z])
+CMD_ARC = 3     # laser-on clockwise arc (G2 X Y R)
+CMD_RAW = 4     # laser-on move formatted with a stored template (imported G-code)
+
+SEGMENT_DTYPE = np.dtype([
+    ('element', np.int32),
+    ('cmd', np.uint8),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('z', np.float64),   # NaN when Z is not changed
+    ('r', np.float64),   # arc radius for CMD_ARC
+    ('feed', np.float32),
+    ('power', np.float32),  # laser power while moving to this row, changes along an element are emitted
+    ('laser', np.bool_),
+    ('template', np.int32),
+])
+
+
+class Toolpath(object):
+    """
+        Array-backed toolpath. Every row is one machine move in absolute printer coordinates,
+        rows with the same element index form one laser-on element (travel + burn moves).
+        G-code text is produced from it in one batch by format_toolpath.
+    """
+    def __init__(self, capacity=1024):
+        self._data = np.zeros(capacity, dtype=SEGMENT_DTYPE)
+        self.size = 0
+        self.element_count = 0
+        self.templates = []
+
+    @property
+    def data(self):
+        return self._data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def __reserve(self, count):
+        if self.size + count > len(self._data):
+            new_data = np.zeros(max(2 * len(self._data), self.size + count), dtype=SEGMENT_DTYPE)
+            new_data[:self.size] = self.data
+            self._data = new_data
+
+    def begin_element(self):
+        self.element_count += 1
+
+    def append(self, cmd, x, y, z=None, r=0, feed=0, power=0, laser=False, template=-1):
+        self.__reserve(1)
+        self._data[self.size] = (self.element_count - 1, cmd, x, y, np.nan if z is None else z,
+                                 r, feed, power, laser, template)
+        self.size += 1
+
+    def append_many(self, cmd, xs, ys, zs=None, r=0, feed=0, power=0, laser=False, template=-1):
+        """ Vectorized append of len(xs) rows to the current element """
+        n = len(xs)
+        self.__reserve(n)
+        rows = self._data[self.size:self.size + n]
+        rows['element'] = self.element_count - 1
+        rows['cmd'] = cmd
+        rows['x'], rows['y'] = xs, ys
+        rows['z'] = np.nan if zs is None else zs
+        rows['r'], rows['feed'], rows['power'], rows['laser'], rows['template'] = r, feed, power, laser, template
+        self.size += n
+
+    def extend(self, rows):
+        """ Appends structured array of SEGMENT_DTYPE rows as is """
+        self.__reserve(len(rows))
+        self._data[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+        if len(rows):
+            self.element_count = max(self.element_count, int(rows['element'].max()) + 1)
+
+    def add_template(self, template):
+        self.templates.append(template)
+        return len(self.templates) - 1
+
+    def clear(self, keep_templates=False):
+        self.size = 0
+        self.element_count = 0
+        if not keep_templates:
+            self.templates = []
+
+    def save(self, path):
+        """ Saves toolpath to .npz file """
+        np.savez(path, segments=self.data, templates=np.array(self.templates, dtype=str))
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as f:
+            res = Toolpath(max(1, len(f['segments'])))
+            res.extend(f['segments'])
+            res.templates = f['templates'].tolist()
+        return res
+
+
+def _fmt_xy(xs, ys, zs):
+    return ['G1  X{:.4f} Y{:.4f}'.format(x, y) if z != z else 'G1  X{:.4f} Y{:.4f} Z{:.4f}'.format(x, y, z)
+            for x, y, z in zip(xs, ys, zs)]
+
+
+def format_toolpath(toolpath, move_speed, pause_before_start_seconds, laser_on=106, laser_off=107):
+    """ Returns list of G-code lines for the whole toolpath """
+    data = toolpath.data
+    if len(data) == 0:
+        return []
+    cmd = data['cmd']
+    body = np.empty(len(data), dtype=object)
+    for kind in (CMD_TRAVEL, CMD_LINE):
+        idx = np.flatnonzero(cmd == kind)
+        body[idx] = _fmt_xy(data['x'][idx].tolist(), data['y'][idx].tolist(), data['z'][idx].tolist())
+    idx = np.flatnonzero(cmd == CMD_Z)
+    body[idx] = ['G1  Z{:.4f}'.format(z) for z in data['z'][idx].tolist()]
+    idx = np.flatnonzero(cmd == CMD_ARC)
+    body[idx] = ['G2  X{:.4f} Y{:.4f} R{:.4f}'.format(x, y, r) for x, y, r in
+                 zip(data['x'][idx].tolist(), data['y'][idx].tolist(), data['r'][idx].tolist())]
+    idx = np.flatnonzero(cmd == CMD_RAW)
+    body[idx] = [toolpath.templates[t].format(x, y) for x, y, t in
+                 zip(data['x'][idx].tolist(), data['y'][idx].tolist(), data['template'][idx].tolist())]
+
+    laser = data['laser']
+    element = data['element']
+    prefix = np.full(len(data), '', dtype=object)
+    suffix = np.full(len(data), '', dtype=object)
+    prefix[cmd == CMD_TRAVEL] = 'G1 F{}\n'.format(move_speed)
+
+    # laser is turned on right before the first burning row of every element
+    on_idx = np.flatnonzero(laser[1:] & ~laser[:-1])
+    suffix[on_idx] = ['\nG4 P0\nM{} S{:g}\nG4 P{:.4f}\nG1 F{:.4f}'.format(laser_on, p, pause_before_start_seconds, f)
+                      for p, f in zip(data['power'][on_idx + 1].tolist(), data['feed'][on_idx + 1].tolist())]
+    # power changes inside burning element (variable power raster), synchronized with the moves like laser on
+    power = data['power']
+    change_idx = np.flatnonzero(laser[1:] & laser[:-1] & (element[1:] == element[:-1]) & (power[1:] != power[:-1])) + 1
+    prefix[change_idx] = ['G4 P0\nM{} S{:g}\n'.format(laser_on, p) for p in power[change_idx].tolist()]
+    last_idx = np.flatnonzero(np.append(element[1:] != element[:-1], True))
+    suffix[last_idx] = suffix[last_idx] + '\nG4 P0\nM{} S0'.format(laser_off)
+    return (prefix + body + suffix).tolist()